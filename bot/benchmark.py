@@ -0,0 +1,792 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import tiktoken
+from aiohttp import web
+
+from history import HistoryStore
+from main import FOLDERS, build_bot, check_folders, configure
+from metrics import TraceFilter
+from offload import Offloader
+from render import RenderScheduler
+from segmenter import Segmenter, split_text
+from storage import JsonFileBackend, JsonLinesBackend
+from stream import StreamEvent, TextBuffer
+from tokens import TokenCounter
+
+BOT_TOKEN = '123456:benchmark'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+WORDS = 'The quick brown fox jumps over the lazy dog, and the *bot* keeps streaming the answer.'.split()
+VOICE = b'OggS' + bytes(2048)  # the fake transcription does not decode the audio
+USER_ID_OFFSET = 1000
+STREAM_TOKENS = [1000, 2000, 4000, 8000]
+TOKEN_HISTORIES = [10, 100, 1000]
+TOKEN_MODEL = 'gpt-3.5-turbo'
+LONG_VOICE_REPEAT = 47  # about 4000 characters
+SEGMENTER_CHARS = [10000, 100000, 1000000]
+
+
+def percentile(values: list, percent: float):
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def summary(values: list):
+    """
+    Distribution of the measured seconds
+    :return: dictionary with the percentiles or None when nothing was measured
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return {'count': len(values), 'p50': percentile(values, 50), 'p99': percentile(values, 99),
+            'mean': statistics.fmean(values), 'max': values[-1]}
+
+
+class FakeOpenAI:
+
+    def __init__(self, args):
+        """
+        OpenAI API stand-in streaming synthetic answers
+        :param args: benchmark arguments
+        """
+        self.tokens = args.tokens
+        self.first_token_latency = args.first_token_latency
+        self.token_latency = args.token_latency
+        self.transcription_latency = args.transcription_latency
+        self.rate_limit_ratio = args.rate_limit_ratio
+        self.random = random.Random(args.seed)
+        self.requests = 0
+        self.rate_limited = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.__chat)
+        app.router.add_post('/v1/audio/transcriptions', self.__transcription)
+        app.router.add_post('/v1/images/generations', self.__image)
+        return app
+
+    def __limited(self):
+        """
+        Injecting the quota errors
+        """
+        self.requests += 1
+        if self.random.random() >= self.rate_limit_ratio:
+            return None
+        self.rate_limited += 1
+        error = {'message': 'Rate limit reached for requests', 'type': 'requests', 'param': None, 'code': None}
+        return web.json_response({'error': error}, status=429, headers={'Retry-After': '1'})
+
+    async def __chat(self, request: web.Request):
+        body = await request.json()
+        limited = self.__limited()
+        if limited is not None:
+            return limited
+        await asyncio.sleep(self.first_token_latency)
+        words = [WORDS[i % len(WORDS)] + ('\n\n' if i % 40 == 39 else ' ') for i in range(self.tokens)]
+        if not body.get('stream'):
+            await asyncio.sleep(self.token_latency * self.tokens)
+            message = {'role': 'assistant', 'content': ''.join(words)}
+            return web.json_response({'object': 'chat.completion', 'model': body['model'],
+                                      'choices': [{'index': 0, 'message': message, 'finish_reason': 'stop'}]})
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for delta in [{'role': 'assistant'}] + [{'content': word} for word in words] + [{}]:
+            chunk = {'object': 'chat.completion.chunk', 'model': body['model'],
+                     'choices': [{'index': 0, 'delta': delta, 'finish_reason': None if delta else 'stop'}]}
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+            await asyncio.sleep(self.token_latency)
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+    async def __transcription(self, request: web.Request):
+        await request.read()
+        limited = self.__limited()
+        if limited is not None:
+            return limited
+        await asyncio.sleep(self.transcription_latency)
+        return web.json_response({'text': 'Tell me something about the benchmark'})
+
+    async def __image(self, request: web.Request):
+        await request.read()
+        limited = self.__limited()
+        if limited is not None:
+            return limited
+        return web.json_response({'created': int(time.time()), 'data': [{'url': 'https://example.com/image.png'}]})
+
+
+class FakeTelegram:
+
+    def __init__(self, args):
+        """
+        Telegram Bot API stand-in simulating the users: every user sends the next message
+        after the previous answer is complete and the think time has passed
+        :param args: benchmark arguments
+        """
+        self.users = args.users
+        self.messages = args.messages
+        self.voice_ratio = args.voice_ratio
+        self.voice_button_ratio = args.voice_button_ratio
+        self.think_time = args.think_time
+        self.random = random.Random(args.seed)
+        self.finished = threading.Event()
+        self.updates = None
+        self.update_id = 0
+        self.message_id = 0
+        self.remaining = {}
+        self.turns = {}
+        self.done = 0
+        self.started = None
+        self.stopped = None
+        self.first_reply = None
+        self.ttft = []
+        self.final = []
+        self.edits = 0
+        self.delivered = 0
+        self.voices = 0
+        self.errors = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.__method)
+        app.router.add_get('/file/bot{token}/{path:.+}', self.__file)
+        app.on_startup.append(self.__setup)
+        return app
+
+    async def __setup(self, app: web.Application):
+        self.updates = asyncio.Queue()
+
+    def begin(self):
+        """
+        Starting the users, run in the loop of the fake servers
+        """
+        self.started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        for user_id in range(USER_ID_OFFSET, USER_ID_OFFSET + self.users):
+            self.remaining[user_id] = self.messages
+            # the first user writes right away to measure the time to the first reply
+            delay = self.random.random() * self.think_time if user_id > USER_ID_OFFSET else 0.0
+            loop.call_later(delay, self.__send, user_id)
+
+    def close(self):
+        """
+        Answering the long poll left by the stopped bot, run in the loop of the fake servers
+        """
+        self.updates.put_nowait(None)
+
+    def __user(self, user_id: int):
+        return {'id': user_id, 'is_bot': False, 'first_name': 'User', 'username': f'user{user_id}'}
+
+    def __message(self, chat_id: int, message_id: int = None, **fields):
+        if message_id is None:
+            self.message_id += 1
+            message_id = self.message_id
+        return dict(message_id=message_id, date=int(time.time()), chat={'id': chat_id, 'type': 'private'}, **fields)
+
+    def __push(self, **update):
+        self.update_id += 1
+        self.updates.put_nowait(dict(update_id=self.update_id, **update))
+
+    def __send(self, user_id: int):
+        """
+        The user sends a text or voice message
+        """
+        self.remaining[user_id] -= 1
+        if self.random.random() < self.voice_ratio:
+            content = {'voice': {'file_id': f'voice{user_id}', 'file_unique_id': f'voice{user_id}', 'duration': 3}}
+        else:
+            number = self.messages - self.remaining[user_id]
+            content = {'text': f'Question {number}: how fast can you answer me?'}
+        self.turns[user_id] = {'sent': time.perf_counter(), 'first': None}
+        self.__push(message=self.__message(user_id, **{'from': self.__user(user_id)}, **content))
+
+    def __press_voice(self, user_id: int, text: str):
+        message = self.__message(user_id, **{'from': BOT_USER}, text=text)
+        self.__push(callback_query={'id': str(self.update_id), 'from': self.__user(user_id),
+                                    'chat_instance': str(user_id), 'data': 'voice', 'message': message})
+
+    def __answered(self, user_id: int, final: bool, text: str = None):
+        """
+        Measuring the answer of the bot, the user goes on after the final message
+        """
+        turn = self.turns.get(user_id)
+        if turn is None:
+            return
+        now = time.perf_counter()
+        if turn['first'] is None:
+            turn['first'] = now
+            self.ttft.append(now - turn['sent'])
+        if not final:
+            return
+        self.final.append(now - turn['sent'])
+        self.first_reply = self.first_reply or now
+        del self.turns[user_id]
+        if text and self.random.random() < self.voice_button_ratio:
+            self.__press_voice(user_id, text)
+        if self.remaining[user_id] > 0:
+            asyncio.get_running_loop().call_later(self.random.random() * 2 * self.think_time, self.__send, user_id)
+            return
+        self.done += 1
+        if self.done == self.users:
+            self.stopped = now
+            self.finished.set()
+
+    async def __get_updates(self, params: dict):
+        limit = int(params.get('limit') or 100)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), float(params.get('timeout') or 0)))
+        except asyncio.TimeoutError:
+            pass
+        while updates and not self.updates.empty() and len(updates) < limit:
+            updates.append(self.updates.get_nowait())
+        updates = [update for update in updates if update is not None]
+        self.delivered += len(updates)
+        return updates
+
+    async def __method(self, request: web.Request):
+        method = request.match_info['method']
+        params = dict(await request.post())
+        chat_id = int(params.get('chat_id') or 0)
+        text = params.get('text', '')
+        markup = 'reply_markup' in params
+        result = True
+        if method == 'getUpdates':
+            result = await self.__get_updates(params)
+        elif method == 'getMe':
+            result = BOT_USER
+        elif method == 'getWebhookInfo':
+            result = {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        elif method == 'getFile':
+            result = {'file_id': params['file_id'], 'file_unique_id': params['file_id'], 'file_size': len(VOICE),
+                      'file_path': f'voice/{params["file_id"]}.oga'}
+        elif method == 'sendMessage':
+            result = self.__message(chat_id, text=text)
+            if text.startswith('Error when requesting'):
+                self.errors += 1
+                self.__answered(chat_id, final=True)
+            elif 'reply_to_message_id' in params and text != '...':
+                self.__answered(chat_id, final=markup, text=text)
+        elif method == 'editMessageText':
+            result = self.__message(chat_id, int(params['message_id']), text=text)
+            self.edits += 1
+            self.__answered(chat_id, final=markup, text=text)
+        elif method == 'sendVoice':
+            self.voices += 1
+            voice = {'file_id': f'tts{self.message_id}', 'file_unique_id': f'tts{self.message_id}', 'duration': 1}
+            result = self.__message(chat_id, voice=voice)
+        elif method == 'sendPhoto':
+            result = self.__message(chat_id)
+        return web.json_response({'ok': True, 'result': result})
+
+    async def __file(self, request: web.Request):
+        return web.Response(body=VOICE, content_type='audio/ogg')
+
+    def results(self, lags: list):
+        duration = (self.stopped or time.perf_counter()) - self.started
+        return {'completed': self.finished.is_set(),
+                'duration': duration,
+                'answers': len(self.final),
+                'errors': self.errors,
+                'voices': self.voices,
+                'time_to_first_token': summary(self.ttft),
+                'time_to_final_edit': summary(self.final),
+                'edits_per_second': self.edits / duration,
+                'updates_per_second': self.delivered / duration,
+                'event_loop_lag': summary(lags),
+                }
+
+
+async def serve(app: web.Application):
+    """
+    Starting the fake server on a free local port
+    :return: the server runner and the base URL of the server
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0, shutdown_timeout=1.0).start()
+    host, port = runner.addresses[0][:2]
+    return runner, f'http://{host}:{port}'
+
+
+async def probe_lag(lags: list, interval: float = 0.05):
+    """
+    Measuring how late the event loop of the bot wakes up
+    """
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, time.perf_counter() - started - interval))
+
+
+def measure_import():
+    """
+    Seconds to start the interpreter and import the bot in a fresh process
+    """
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import main'], cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    return time.perf_counter() - started
+
+
+class StreamMessage:
+    """
+    Message of the stream micro-benchmark, the edits are only counted
+    """
+
+    def __init__(self, counter: list):
+        self.text = '...'
+        self.counter = counter
+
+    async def reply(self, text: str):
+        return StreamMessage(self.counter)
+
+    async def edit_text(self, text: str, **kwargs):
+        self.text = text
+        self.counter[0] += 1
+
+    async def delete(self):
+        pass
+
+
+async def stream_answer(tokens: int):
+    """
+    Events of a streamed answer built like GPT.create_chat_stream does
+    """
+    buffer = TextBuffer()
+    for i in range(tokens):
+        delta = WORDS[i % len(WORDS)] + ('\n\n' if i % 97 == 96 else ' ')
+        buffer.append(delta)
+        yield StreamEvent(delta)
+    yield StreamEvent(finish_reason='stop', text=buffer.text.strip())
+
+
+async def render_stream(tokens: int):
+    """
+    Rendering a streamed answer the way TelegramBot does, every token is edited without the rate limits
+    :return: number of the message edits
+    """
+    edits = [0]
+    render = RenderScheduler({'edit_interval': 0.0, 'edit_min_chars': 40, 'chat_rate': 1e9, 'global_rate': 1e9})
+    message = StreamMessage(edits)
+    content = await message.reply('...')
+    renderer, segmenter = render.stream(0, content), Segmenter(4096)
+    async for event in stream_answer(tokens):
+        for segment in segmenter.feed(event.delta):
+            await renderer.finish(segment)
+            content = await message.reply('...')
+            renderer = render.stream(0, content)
+        if event.finish_reason is None:
+            if renderer.due(len(segmenter)):
+                await renderer.update(segmenter.tail)
+            continue
+        for chunk in segmenter.close():
+            await renderer.finish(chunk)
+    return edits[0]
+
+
+def measure_stream(sizes: list):
+    """
+    Time and memory per token of streaming and rendering long answers
+    :param sizes: numbers of tokens in the answers
+    :return: dictionary with the results of every size
+    """
+    results = {}
+    for tokens in sizes:
+        started = time.perf_counter()
+        edits = asyncio.run(render_stream(tokens))
+        elapsed = time.perf_counter() - started
+        tracemalloc.start()
+        asyncio.run(render_stream(tokens))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[str(tokens)] = {'edits': edits, 'seconds_per_token': elapsed / tokens,
+                                'peak_bytes': peak, 'peak_bytes_per_token': peak / tokens}
+    return results
+
+
+def generated_text(chars: int):
+    """
+    Long answer with paragraphs, lists and code blocks
+    """
+    parts, size = [], 0
+    while size < chars:
+        if len(parts) % 7 == 6:
+            part = '```python\n' + '\n'.join(f'print({n})' for n in range(20)) + '\n```\n\n'
+        elif len(parts) % 5 == 4:
+            part = '\n'.join(f'- {word}' for word in WORDS) + '\n\n'
+        else:
+            part = ' '.join(WORDS * 3) + '\n\n'
+        parts.append(part)
+        size += len(part)
+    return ''.join(parts)[:chars]
+
+
+def measure_segmenter(sizes: list, delta: int = 8):
+    """
+    Time per character of splitting long texts at once and as stream deltas, it stays flat when the splitting is linear
+    :param sizes: numbers of characters in the texts
+    :param delta: characters in every stream delta
+    :return: dictionary with the results of every size
+    """
+    results = {}
+    for chars in sizes:
+        text = generated_text(chars)
+        deltas = [text[start:start + delta] for start in range(0, chars, delta)]
+        started = time.perf_counter()
+        segments = split_text(text, 4096)
+        whole = time.perf_counter() - started
+        started = time.perf_counter()
+        segmenter = Segmenter(4096)
+        for part in deltas:
+            segmenter.feed(part)
+        segmenter.close()
+        streamed = time.perf_counter() - started
+        results[str(chars)] = {'segments': len(segments), 'split_seconds_per_char': whole / chars,
+                               'stream_seconds_per_char': streamed / chars}
+    return results
+
+
+class FilePerCallHistory:
+    """
+    History access of the bot before the history store: every call reads or rewrites the JSON file on the event loop
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+
+    def read(self, chat_id: str):
+        with open(f'{self.folder}/{chat_id}.json', "r", encoding="UTF8") as file:
+            return json.load(file)
+
+    def write(self, chat_id: str, data: dict):
+        with open(f'{self.folder}/{chat_id}.json', "w", encoding="UTF8") as file:
+            json.dump(data, file, indent=4)
+
+    def turn(self, chat_id: str, question: dict, answer: dict):
+        """
+        The reads and writes of one chat turn: the request, the prompt and the answer are saved separately
+        """
+        history = self.read(chat_id)['history']
+        history.append(question)
+        self.write(chat_id, dict(self.read(chat_id), history=history))
+        history = self.read(chat_id)['history']
+        history.append(answer)
+        self.write(chat_id, dict(self.read(chat_id), history=history))
+
+
+async def store_turns(backend, chats: int, turns: int, question: dict, answer: dict):
+    """
+    Chat turns through the history store, the histories are written on the periodic flush and at the end
+    :return: seconds of all turns including the final flush
+    """
+    offload = Offloader({'io_threads': 8, 'cpu_processes': 1, 'cpu_threshold': 10 ** 9, 'lag_threshold': 0})
+    store = HistoryStore({'cache_size': 1000, 'flush_interval': 1.0}, offload, backend)
+    for chat in range(chats):
+        store.set(str(chat), {'username': f'user{chat}', 'history': [{"role": "system", "content": "You are a bot."}]})
+    await store.flush()
+    started = time.perf_counter()
+    store.start()
+    for _ in range(turns):
+        for chat in range(chats):
+            for message in (question, answer):
+                data = await store.get(str(chat))
+                data['history'].append(dict(message))
+                store.set(str(chat), data)
+    await store.close()
+    elapsed = time.perf_counter() - started
+    offload.io_pool.shutdown()
+    return elapsed
+
+
+def measure_history(chats: int, turns: int):
+    """
+    Chat turns per second of the history store against reading and writing the JSON file on every call
+    :param chats: number of chats
+    :param turns: turns of every chat
+    :return: dictionary with the turns per second of every path
+    """
+    question = {"role": "user", "content": ' '.join(WORDS * 3)}
+    answer = {"role": "assistant", "content": ' '.join(WORDS * 12)}
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='chatgptbot-history-') as folder:
+        files = FilePerCallHistory(folder)
+        for chat in range(chats):
+            files.write(str(chat), {'username': f'user{chat}', 'history': [{"role": "system", "content": "You are a bot."}]})
+        started = time.perf_counter()
+        for _ in range(turns):
+            for chat in range(chats):
+                files.turn(str(chat), question, answer)
+        results['file_per_call'] = chats * turns / (time.perf_counter() - started)
+    for name, backend in (('store_json', JsonFileBackend), ('store_jsonl', JsonLinesBackend)):
+        with tempfile.TemporaryDirectory(prefix='chatgptbot-history-') as folder:
+            elapsed = asyncio.run(store_turns(backend(folder), chats, turns, question, answer))
+            results[name] = chats * turns / elapsed
+    return {'chats': chats, 'turns': turns, 'turns_per_second': results}
+
+
+def count_full(model: str, messages: list):
+    """
+    Token count of the bot before the token accounting: the encoder is resolved and the whole history
+    is encoded on every turn
+    """
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    num_tokens = 0
+    for message in messages:
+        num_tokens += 4
+        for key, value in message.items():
+            num_tokens += len(encoding.encode(value))
+            if key == "name":
+                num_tokens += -1
+    return num_tokens + 2
+
+
+async def count_incremental(history: list, turns: int):
+    """
+    Token accounting of the chat turns, only the new message is encoded
+    :return: seconds of all turns
+    """
+    counter = TokenCounter(TOKEN_MODEL)
+    data = {'history': [dict(message) for message in history]}
+    await counter.annotate(data)
+    started = time.perf_counter()
+    for turn in range(turns):
+        await counter.append(data, 'user', f'{turn} {" ".join(WORDS)}')
+        counter.count_messages(data['history'])
+    return time.perf_counter() - started
+
+
+def measure_tokens(sizes: list, turns: int = 20):
+    """
+    Time per turn of counting the tokens of the request against encoding the whole history
+    :param sizes: numbers of messages in the histories
+    :param turns: turns measured on every history
+    :return: dictionary with the results of every size
+    """
+    results = {}
+    for size in sizes:
+        history = [{"role": "user" if n % 2 else "assistant", "content": f'{n} {" ".join(WORDS * 2)}'}
+                   for n in range(size)]
+        started = time.perf_counter()
+        for turn in range(turns):
+            history.append({"role": "user", "content": f'{turn} {" ".join(WORDS)}'})
+            count_full(TOKEN_MODEL, history)
+        full = (time.perf_counter() - started) / turns
+        incremental = asyncio.run(count_incremental(history[:size], turns)) / turns
+        results[str(size)] = {'full_seconds_per_turn': full, 'incremental_seconds_per_turn': incremental}
+    return results
+
+
+async def voice_request(announcer, text: str):
+    """
+    Seconds until the first voice of the text is ready to be sent and until all of them are
+    """
+    started = time.perf_counter()
+    first, voices = None, 0
+    async for _ in announcer.voicing(text):
+        voices += 1
+        if first is None:
+            first = time.perf_counter() - started
+    return first, time.perf_counter() - started, voices
+
+
+async def measure_voicing(requests: int):
+    """
+    Latency of the first voice request of a cold bot against the requests with the models in memory
+    and the time to the first audio of long answers, every request has its own text to miss the voice cache
+    :param requests: number of the warm requests
+    :return: dictionary with the latencies in seconds
+    """
+    started = time.perf_counter()
+    from voicing import Announcer  # the import of torch is a part of the startup
+    announcer = await asyncio.to_thread(Announcer, configure()['voicing'])
+    created = time.perf_counter() - started
+    _, first, _ = await voice_request(announcer, f'0. {" ".join(WORDS)}')
+    warm = [(await voice_request(announcer, f'{n}. {" ".join(WORDS)}'))[1] for n in range(1, requests + 1)]
+    # a long answer is voiced in several parts, the first one is sent while the others are synthesised
+    long = [await voice_request(announcer, f'{n}. {" ".join(WORDS * LONG_VOICE_REPEAT)}')
+            for n in range(1, requests + 1)]
+    announcer.workers.shutdown()
+    return {'create': created, 'first_request': first, 'startup': created + first, 'warm': summary(warm),
+            'long_answer': {'chars': len(" ".join(WORDS * LONG_VOICE_REPEAT)), 'voices': long[0][2],
+                            'time_to_first_audio': summary([result[0] for result in long]),
+                            'time_to_all_audio': summary([result[1] for result in long])}}
+
+
+def enter_workdir():
+    """
+    Moving to a temporary folder, the histories and voices of the benchmark do not mix with the real ones
+    and the speech models are shared to be downloaded only once
+    """
+    models = os.path.abspath('models')
+    os.makedirs(models, exist_ok=True)
+    os.chdir(tempfile.mkdtemp(prefix='chatgptbot-benchmark-'))
+    os.symlink(models, 'models')
+    check_folders(FOLDERS)
+
+
+async def drive(bot, telegram: FakeTelegram, fake_loop, timeout: float, created: float):
+    """
+    Running the bot until the users have sent all their messages
+    :param created: time the bot creation started
+    """
+    bot._reg_handler(bot.dp)
+    await bot._on_startup(bot.dp)
+    ready = time.perf_counter() - created
+    lags = []
+    probe = asyncio.create_task(probe_lag(lags))
+    polling = asyncio.create_task(bot.dp.start_polling())
+    fake_loop.call_soon_threadsafe(telegram.begin)
+
+    await asyncio.get_running_loop().run_in_executor(None, telegram.finished.wait, timeout)
+    bot.dp.stop_polling()
+    polling.cancel()
+    probe.cancel()
+    await asyncio.gather(polling, probe, return_exceptions=True)
+    await bot._on_shutdown(bot.dp)
+    await (await bot.bot.get_session()).close()
+    results = telegram.results(lags)
+    results['startup'] = {'ready': ready,
+                          'first_reply': telegram.first_reply - created if telegram.first_reply else None,
+                          'voice_ready': bot.speech.ready_time}
+    return results
+
+
+def flatten(results: dict, prefix: str = ''):
+    metrics = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            metrics.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics[f'{prefix}{key}'] = value
+    return metrics
+
+
+def compare(results: dict, baseline: dict):
+    """
+    Printing the change of every metric against a previous run
+    """
+    current, previous = flatten(results), flatten(baseline)
+    for key, value in current.items():
+        if key.startswith('params.') or key not in previous:
+            continue
+        change = f'{(value - previous[key]) / previous[key] * 100:+.1f}%' if previous[key] else 'n/a'
+        print(f'{key:40} {previous[key]:12.4f} -> {value:12.4f} {change}')
+
+
+def report(results: dict, output: str, baseline: str = None):
+    """
+    Saving and printing the results, comparing them with a previous run if there is one
+    """
+    with open(output, "w", encoding="UTF8") as file:
+        json.dump(results, file, indent=4)
+    print(json.dumps({key: value for key, value in results.items() if key != 'params'}, indent=4))
+    if baseline:
+        with open(baseline, "r", encoding="UTF8") as file:
+            compare(results, json.load(file))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the bot against local fake Telegram and OpenAI servers')
+    parser.add_argument('--users', type=int, default=20, help='number of simulated users')
+    parser.add_argument('--messages', type=int, default=5, help='messages sent by every user')
+    parser.add_argument('--voice-ratio', type=float, default=0.2, help='share of voice messages')
+    parser.add_argument('--voice-button-ratio', type=float, default=0.0,
+                        help='share of answers voiced with the button, needs the speech models')
+    parser.add_argument('--think-time', type=float, default=1.0, help='mean seconds between an answer and the next message')
+    parser.add_argument('--tokens', type=int, default=150, help='tokens in every answer')
+    parser.add_argument('--first-token-latency', type=float, default=0.3, help='seconds before the first token')
+    parser.add_argument('--token-latency', type=float, default=0.02, help='seconds between the streamed tokens')
+    parser.add_argument('--transcription-latency', type=float, default=0.5, help='seconds of every transcription')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='share of OpenAI requests answered with 429')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=600.0, help='seconds after which the run is stopped')
+    parser.add_argument('--output', default='benchmark.json', help='file to save the results to')
+    parser.add_argument('--baseline', help='results of a previous run to compare with')
+    parser.add_argument('--verbose', action='store_true', help='show the logs of the bot')
+    parser.add_argument('--stream', type=int, nargs='*', metavar='TOKENS',
+                        help=f'only run the micro-benchmark of the answer streaming, {STREAM_TOKENS} tokens by default')
+    parser.add_argument('--history', action='store_true',
+                        help='only compare the history store with the file per call, --users chats of --messages turns')
+    parser.add_argument('--token-count', type=int, nargs='*', metavar='MESSAGES',
+                        help=f'only compare the token accounting with counting the whole history, '
+                             f'histories of {TOKEN_HISTORIES} messages by default')
+    parser.add_argument('--voicing', action='store_true',
+                        help='only compare the first voice request of a cold bot with --messages warm requests')
+    parser.add_argument('--segmenter', type=int, nargs='*', metavar='CHARS',
+                        help=f'only measure the text splitting, texts of {SEGMENTER_CHARS} characters by default')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+
+    if args.stream is not None:
+        report({'stream': measure_stream(args.stream or STREAM_TOKENS)}, output, baseline)
+        return
+    if args.history:
+        report({'history': measure_history(args.users, args.messages)}, output, baseline)
+        return
+    if args.token_count is not None:
+        report({'tokens': measure_tokens(args.token_count or TOKEN_HISTORIES)}, output, baseline)
+        return
+    if args.segmenter is not None:
+        report({'segmenter': measure_segmenter(args.segmenter or SEGMENTER_CHARS)}, output, baseline)
+        return
+    if args.voicing:
+        # only the voicing settings are used, the required tokens may be missing
+        os.environ.setdefault('TOKEN_TELEGRAM', BOT_TOKEN)
+        os.environ.setdefault('TOKEN_OPENAI', 'sk-benchmark')
+        enter_workdir()
+        report({'voicing': asyncio.run(measure_voicing(args.messages))}, output, baseline)
+        return
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s',
+                        level=logging.INFO if args.verbose else logging.WARNING)
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceFilter())
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)  # requests to the fake servers
+    enter_workdir()
+
+    fake_loop = asyncio.new_event_loop()
+    threading.Thread(target=fake_loop.run_forever, name='fake-servers', daemon=True).start()
+    openai_server, telegram = FakeOpenAI(args), FakeTelegram(args)
+    servers = [asyncio.run_coroutine_threadsafe(serve(app), fake_loop).result()
+               for app in (openai_server.app(), telegram.app())]
+    (_, openai_url), (_, telegram_url) = servers
+
+    os.environ.pop('WEBHOOK_URL', None)
+    os.environ.update({'TOKEN_TELEGRAM': BOT_TOKEN, 'TOKEN_OPENAI': 'sk-benchmark',
+                       'TELEGRAM_API_SERVER': telegram_url, 'BASE_API': f'{openai_url}/v1',
+                       'ALLOWED_TELEGRAM_USER_IDS': '*', 'ALLOWED_USERS_FILE': ''})
+    import_time = measure_import()
+    created = time.perf_counter()
+    bot = build_bot(configure())
+    results = asyncio.run(drive(bot, telegram, fake_loop, args.timeout, created))
+    results['startup']['import'] = import_time
+    results['openai'] = {'requests': openai_server.requests, 'rate_limited': openai_server.rate_limited}
+    results['params'] = vars(args)
+    fake_loop.call_soon_threadsafe(telegram.close)
+    for runner, _ in servers:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), fake_loop).result()
+    fake_loop.call_soon_threadsafe(fake_loop.stop)
+
+    if not results['completed']:
+        logging.warning(f'The users did not finish within {args.timeout}s, the results are partial')
+    report(results, output, baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class ChatQueue:
+
+    def __init__(self, config: dict):
+        """
+        Serializing model requests per chat, unrelated chats stay parallel
+        :param config: dictionary with bot configurations
+        """
+        self.window = config['coalesce_window']
+        self._locks = {}
+        self._pending = {}
+
+    @asynccontextmanager
+    async def turn(self, chat_id: str, text: str):
+        """
+        Waiting for the previous request of the chat to finish
+        :param chat_id: Telegram chat id
+        :param text: Message from user
+        :return: the text to send to the model or None if it was merged into another request
+        """
+        pending = None
+        if self.window > 0:
+            if chat_id in self._pending:
+                self._pending[chat_id].append(text)
+                yield None
+                return
+            pending = self._pending[chat_id] = [text]
+
+        try:
+            if pending is not None:
+                await asyncio.sleep(self.window)
+            async with self.__lock(chat_id):
+                if pending is not None:
+                    # messages that arrived while waiting for the window or the lock go as one request
+                    text = "\n".join(self._pending.pop(chat_id))
+                yield text
+        finally:
+            # a request cancelled while waiting must not swallow the next messages of the chat
+            if pending is not None and self._pending.get(chat_id) is pending:
+                del self._pending[chat_id]
+
+    @asynccontextmanager
+    async def __lock(self, chat_id: str):
+        entry = self._locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[chat_id]
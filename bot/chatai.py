@@ -1,19 +1,37 @@
-import json
+import io
 import logging
+import time
+import uuid
 
 import openai
-import soundfile as sf
-import tiktoken
-from openai.error import InvalidRequestError
-import os
+from openai.error import InvalidRequestError, RateLimitError
+
+from context import ContextManager
+from history import HistoryStore
+from metrics import OPENAI_TOKENS, RESPONSE_CACHE, TIME_TO_FIRST_TOKEN
+from offload import Offloader
+from openai_client import OpenAIClient
+from response_cache import ResponseCache
+from scheduler import QueueOverloaded
+from stream import StreamEvent, TextBuffer
+from tokens import TokenCounter
+
+IMAGE_URL_TTL = 3000  # DALL·E links expire after an hour
+REPLAY_CHUNK = 200
 
 
 class GPT:
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, history: HistoryStore, client: OpenAIClient, offload: Offloader):
         openai.api_key = config["token_openai"]
         openai.proxy = config['proxy']
         openai.api_base = config['base_api']
         self.config = config
+        self.history = history
+        self.client = client
+        self.offload = offload
+        self.counter = TokenCounter(config['model'], offload)
+        self.context = ContextManager(config, history, self.counter, self.__summarise)
+        self.cache = ResponseCache(config)
 
     async def create_chat(self, message: str, chat_id: str):
         """
@@ -22,11 +40,19 @@ class GPT:
         :param chat_id: Telegram chat id
         :return: The answer from the model
         """
-        response = await self._generate_gpt_response(message, chat_id, stream=False)
-        answer = response.choices[0]['message']['content'].strip()
-        history = self.__read_file(chat_id)['history']
-        history.append({"role": "assistant", "content": answer})
-        self.__add_to_history(history, chat_id)
+        # the chat is held for the whole turn, a per-chat lock only blocks the workers serving the same chat
+        async with self.history.turn(chat_id):
+            request, key = await self._prepare_request(message, chat_id)
+            answer = self.__cached(key, 'chat')
+            cached = answer is not None
+            if not cached:
+                response = await self._generate_gpt_response(request, chat_id, stream=False)
+                answer = response.choices[0]['message']['content'].strip()
+                self.__remember(key, answer)
+            data = await self.__add_to_history("assistant", answer, chat_id)
+            if not cached:
+                self.__count_completion(data)
+        self.context.refresh(chat_id, data)
 
         return answer
 
@@ -35,113 +61,187 @@ class GPT:
         Stream response from the GTP model
         :param message: Message from user
         :param chat_id: Telegram chat id
-        :return: The answer from the model or 'not_finished'
-        """
-        response = await self._generate_gpt_response(message, chat_id, stream=True)
-        answer = ''
-        async for item in response:
-            if 'choices' not in item or len(item.choices) == 0:
-                continue
-            delta = item.choices[0].delta
-            if 'content' in delta:
-                answer += delta.content
-                yield answer, False
-        answer = answer.strip()
-        history = self.__read_file(chat_id)['history']
-        history.append({"role": "assistant", "content": answer})
-        self.__add_to_history(history, chat_id)
-        yield answer, True
-
-    async def _generate_gpt_response(self, message, chat_id, stream=True):
+        :return: Text deltas of the answer, the last event has the finish reason, the usage and the whole answer
         """
-        Request a response from the GPT model
+        started = time.perf_counter()
+        # the chat is held until the answer is added, only the workers serving the same chat wait for it
+        async with self.history.turn(chat_id):
+            request, key = await self._prepare_request(message, chat_id)
+            answer = self.__cached(key, 'chat')
+            cached = answer is not None
+            finish_reason, usage = 'stop', None
+            if cached:
+                TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - started, cached='true')
+                # the cached answer goes through the same rendering as a streamed one
+                for start in range(0, len(answer), REPLAY_CHUNK):
+                    yield StreamEvent(answer[start:start + REPLAY_CHUNK])
+            else:
+                response = await self._generate_gpt_response(request, chat_id, stream=True)
+                buffer = TextBuffer()
+                try:
+                    async for item in response:
+                        if 'choices' not in item or len(item.choices) == 0:
+                            continue
+                        choice = item.choices[0]
+                        finish_reason = choice.get('finish_reason') or finish_reason
+                        if choice.delta.get('content'):
+                            if not buffer:
+                                TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - started, cached='false')
+                            buffer.append(choice.delta.content)
+                            yield StreamEvent(choice.delta.content)
+                finally:
+                    # frees the connection and the concurrency slot when the reader stops early
+                    await response.aclose()
+                answer = buffer.text.strip()
+                self.__remember(key, answer)
+            data = await self.__add_to_history("assistant", answer, chat_id)
+            if not cached:
+                usage = {'prompt_tokens': self.counter.count_messages(request['messages']),
+                         'completion_tokens': data['history'][-1]['tokens']}
+                self.__count_completion(data)
+        self.context.refresh(chat_id, data)
+        yield StreamEvent(finish_reason=finish_reason, usage=usage, text=answer)
+
+    async def _prepare_request(self, message, chat_id):
+        """
+        Adding the message to the history and building the model request
         :param message: The message to send to the model
+        :param chat_id: Telegram chat id
+        :return: The request parameters and the response cache key or None when the cache is not used
+        """
+        data = await self.__add_to_history("user", message, chat_id)
+        # the history may be the same list, the answer appended to it is not a part of the request
+        messages = list(self.context.fit(chat_id, data))
+        self.__write_to_file(data, chat_id)
+
+        request = {
+            'model': self.config["model"],
+            'messages': messages,
+            'temperature': self.config["temperature"],
+            'max_tokens': self.config["max_tokens"],
+            'n': 1,
+            'presence_penalty': self.config["presence_penalty"],
+            'frequency_penalty': self.config["frequency_penalty"],
+        }
+        key = None
+        if self.cache.enabled(self.config["temperature"]):
+            key = self.cache.key(**dict(request, messages=self.cache.normalise(self.counter.strip(messages))))
+        return request, key
+
+    async def _generate_gpt_response(self, request: dict, chat_id, stream=True):
+        """
+        Request a response from the GPT model
+        :param request: The request parameters
+        :param chat_id: Telegram chat id
         :return: The response from the model
         """
-        history = self.__read_file(chat_id)['history']
-        history.append({"role": "user", "content": message})
-        token_len = self.num_tokens_from_messages(history, self.config["model"])
-        if token_len + self.config['max_tokens'] > self.config['max_all_tokens']:
-            logging.warning(
-                f"This model's maximum context length is 4097 tokens."
-                f" {token_len} in the messages, 1200 in the completion")
-            summarize = await self.__summarise(history[:-1])
-            self.clear_history(chat_id)
-            history = self.__read_file(chat_id)['history']
-            history.append({"role": "assistant", "content": summarize})
-            history.append({"role": "user", "content": message})
-        self.__add_to_history(history, chat_id)
-
-        return await openai.ChatCompletion.acreate(
-            model=self.config["model"],
-            messages=history,
-            temperature=self.config["temperature"],
-            max_tokens=self.config["max_tokens"],
-            n=1,
-            presence_penalty=self.config["presence_penalty"],
-            frequency_penalty=self.config["frequency_penalty"],
-            stream=stream)
+        prompt = self.counter.count_messages(request['messages'])
+        response = await self.client.call(
+            'chat',
+            openai.ChatCompletion.acreate,
+            user=chat_id,
+            tokens=prompt + self.config['max_tokens'],
+            stream=stream,
+            request_timeout=self.config['request_timeout'],
+            **dict(request, messages=self.counter.strip(request['messages'])))
+        OPENAI_TOKENS.inc(prompt, model=request['model'], kind='prompt')
+        return response
 
-    async def generate_image(self, prompt: str):
+    def __count_completion(self, data: dict):
+        OPENAI_TOKENS.inc(data['history'][-1]['tokens'], model=self.config["model"], kind='completion')
+
+    def __cached(self, key, kind: str):
+        if key is None:
+            return None
+        answer = self.cache.get(key)
+        RESPONSE_CACHE.inc(kind=kind, result='miss' if answer is None else 'hit')
+        if answer is not None:
+            logging.debug(f'Response cache hit: {self.cache.stats()}')
+        return answer
+
+    def __remember(self, key, value, ttl=None):
+        if key is not None and value:
+            self.cache.put(key, value, ttl)
+
+    async def generate_image(self, prompt: str, chat_id: str = None):
         """
         Generates images with DALL·E on prompt
         :param prompt: The prompt to send to the model
+        :param chat_id: Telegram chat id
         :return: The image URL
         """
+        key = None
+        if self.cache.enabled():
+            key = self.cache.key(prompt=' '.join(prompt.split()), size=self.config["image_size"])
+        image_url = self.__cached(key, 'image')
+        if image_url is not None:
+            return image_url
         try:
-            response = await openai.Image.acreate(
+            response = await self.client.call(
+                'image',
+                openai.Image.acreate,
+                user=chat_id,
                 prompt=prompt,
                 n=1,
                 size=self.config["image_size"]
             )
             image_url = response['data'][0]['url']
+            self.__remember(key, image_url, IMAGE_URL_TTL)
             return image_url
-        except InvalidRequestError as e:
+        except (InvalidRequestError, RateLimitError) as e:
             return e.user_message
+        except QueueOverloaded as e:
+            return str(e)
 
-    async def transcriptions(self, chat_id: str):
+    async def transcriptions(self, voice: io.BytesIO, chat_id: str):
         """
-        Transcribes the audio file using the Whisper model.
+        Transcribes the voice message using the Whisper model.
+        :param voice: OGG/Opus voice message in memory
         :param chat_id: Telegram chat id
         :return: Text decoding of audio
         """
-        with open(f"audio/{chat_id}.wav", "rb") as audio:
-            result = await openai.Audio.atranscribe("whisper-1", audio)
+        if self.config['keep_audio']:
+            await self.offload.run_io(self.__keep_audio, voice.getvalue(), chat_id)
+        if self.config['transcode_audio']:
+            voice = await self.convert_audio(voice)
+
+        async def transcribe(**kwargs):
+            voice.seek(0)  # the buffer is read again on retries
+            return await openai.Audio.atranscribe(**kwargs)
 
-            return result.text
+        result = await self.client.call('transcription', transcribe, user=chat_id, model="whisper-1", file=voice)
+        return result.text
 
-    async def convert_audio(self, chat_id):
+    async def convert_audio(self, voice: io.BytesIO):
         """
-        Converts the .ogg file format to .wav
+        Converts the .ogg voice message to .wav in memory
         """
-        ogg_file = f"audio/{chat_id}.ogg"
-        wav_file = f"audio/{chat_id}.wav"
+        return await self.offload.run_io(self.__convert_audio, voice)
 
-        data, samplerate = sf.read(ogg_file)
-        sf.write(wav_file, data, samplerate)
+    @staticmethod
+    def __convert_audio(voice: io.BytesIO):
+        import soundfile as sf  # numpy is only needed when transcoding
+        voice.seek(0)
+        data, samplerate = sf.read(voice)
+        wav = io.BytesIO()
+        sf.write(wav, data, samplerate, format='WAV')
+        wav.name = 'voice.wav'
+        return wav
 
-    async def delete_audio(self, chat_id):
-        os.remove(f"audio/{chat_id}.ogg")
-        os.remove(f"audio/{chat_id}.wav")
+    @staticmethod
+    def __keep_audio(data: bytes, chat_id: str):
+        """
+        Saving the voice message for debugging
+        """
+        with open(f"audio/{chat_id}_{uuid.uuid4().hex}.ogg", "wb") as file:
+            file.write(data)
 
-    def num_tokens_from_messages(self, messages, model="gpt-3.5-turbo-0301"):
+    def num_tokens_from_messages(self, messages, model=None):
         """Returns the number of tokens used by a list of messages."""
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("cl100k_base")
-        if model == self.config["model"]:  # note: future models may deviate from this
-            num_tokens = 0
-            for message in messages:
-                num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-                for key, value in message.items():
-                    num_tokens += len(encoding.encode(value))
-                    if key == "name":  # if there's a name, the role is omitted
-                        num_tokens += -1  # role is always required and always 1 token
-            num_tokens += 2  # every reply is primed with <im_start>assistant
-            return num_tokens
-
-    async def __summarise(self, conversation) -> str:
+        counter = self.counter if model in (None, self.counter.model) else TokenCounter(model)
+        return counter.count_messages(messages)
+
+    async def __summarise(self, conversation: list) -> str:
         """
         Summarises the conversation history.
         :param conversation: The conversation history
@@ -151,69 +251,87 @@ class GPT:
             {"role": "assistant", "content": "Summarize this conversation in 700 characters or less"},
             {"role": "user", "content": str(conversation)}
         ]
-        response = await openai.ChatCompletion.acreate(
+        response = await self.client.call(
+            'summary',
+            openai.ChatCompletion.acreate,
+            tokens=await self.counter.measure(messages[1]) + self.counter.count_messages(messages[:1]),
             model=self.config["model"],
             messages=messages,
             temperature=0.4
         )
+        usage = response.get('usage', {})
+        OPENAI_TOKENS.inc(usage.get('prompt_tokens', 0), model=self.config["model"], kind='prompt')
+        OPENAI_TOKENS.inc(usage.get('completion_tokens', 0), model=self.config["model"], kind='completion')
         return response.choices[0]['message']['content']
 
     def __write_to_file(self, data, chat_id: str):
         """
-        Writing to the history file
+        Writing to the history store, the file is updated on the next flush
         :param data: Data with chat history
         :param chat_id: Telegram chat id
         """
-        with open(f'history/{chat_id}.json', "w", encoding="UTF8") as file:
-            json.dump(data, file, indent=4)
+        self.history.set(chat_id, data)
 
-    def __read_file(self, chat_id: str):
+    async def __read_file(self, chat_id: str):
         """
-        Read history file
+        Read history from the store
         :param chat_id: Telegram chat id
         :return: list with chat history
         """
-        with open(f'history/{chat_id}.json', "r", encoding="UTF8") as file:
-            return json.load(file)
+        return await self.history.get(chat_id)
 
-    def create_user_history(self, chat_id, username):
+    async def create_user_history(self, chat_id, username):
         """
         Creating a history file for a new user
         :param chat_id: Telegram chat id
         :param username: Telegram username
         """
-        if not os.path.isfile(f'history/{chat_id}.json'):
-            self.__write_to_file({
+        if await self.history.exists(chat_id):
+            return
+        async with self.history.turn(chat_id):
+            if await self.history.exists(chat_id):
+                return
+            data = {
                 'username': username,
                 'history': [{"role": "system", "content": "You are a helpful assistant."}],
-            }, chat_id)
+            }
+            await self.counter.annotate(data)
+            self.__write_to_file(data, chat_id)
             logging.info(f"A history file was created for a user {username} (id: {chat_id})")
 
-    def __add_to_history(self, history: list, chat_id):
+    async def __add_to_history(self, role: str, content: str, chat_id):
         """
-        Adding a prompt and response from a model in the history file
-        :param history: chat history list
+        Adding a prompt or response from a model in the history
+        :param role: message author role
+        :param content: message text
         :param chat_id: Telegram chat id
+        :return: Data with chat history
         """
-        result = self.__read_file(chat_id)
-        result['history'] = history
+        result = await self.__read_file(chat_id)
+        await self.counter.append(result, role, content)
         self.__write_to_file(result, chat_id)
+        return result
 
-    def system_message(self, message: str, chat_id):
+    async def system_message(self, message: str, chat_id):
         """
         Changing the system role message
         :param message: system role message
         :param chat_id: Telegram chat id
         """
-        result = self.__read_file(chat_id)
-        result['history'][0].update({"content": message})
-        self.__write_to_file(result, chat_id)
+        async with self.history.turn(chat_id):
+            result = await self.__read_file(chat_id)
+            result['history'][0] = {"role": "system", "content": message}
+            await self.counter.annotate(result)
+            self.__write_to_file(result, chat_id)
 
-    def clear_history(self, chat_id: str):
+    async def clear_history(self, chat_id: str):
         """
         Cleaning the chat history file
         :param chat_id: Telegram chat id
         """
-        result = self.__read_file(chat_id)
-        result['history'] = [{"role": "system", "content": ""}]
-        self.__write_to_file(result, chat_id)
+        self.context.reset(chat_id)
+        async with self.history.turn(chat_id):
+            result = await self.__read_file(chat_id)
+            result['history'] = result['history'][:1]
+            await self.counter.annotate(result)
+            self.__write_to_file(result, chat_id)
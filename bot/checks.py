@@ -0,0 +1,408 @@
+import argparse
+import asyncio
+import fnmatch
+import sys
+import threading
+import time
+import traceback
+from contextlib import asynccontextmanager
+
+from context import ContextManager
+from history import HistoryStore
+from offload import Offloader
+from storage import RedisBackend
+from segmenter import Segmenter, split_text
+
+CHECKS = []
+
+
+def check(func):
+    """
+    Registering an offline check, the check fails with an AssertionError
+    """
+    CHECKS.append(func)
+    return func
+
+
+@check
+def segmenter_skips_leading_whitespace():
+    """
+    Whitespace before a code block longer than the limit gives no empty segment
+    """
+    text = ' \n\n```\n' + 'code line\n' * 5 + '```\nafter'
+    for limit in (20, 27, 40):
+        segments = split_text(text, limit)
+        assert segments and all(segment.strip() for segment in segments), segments
+        assert all(len(segment) <= limit for segment in segments), segments
+        segmenter = Segmenter(limit)
+        streamed = [segment for n in range(0, len(text), 3) for segment in segmenter.feed(text[n:n + 3])]
+        streamed += segmenter.close()
+        assert all(segment.strip() for segment in streamed), streamed
+
+
+class WordCounter:
+    """
+    Token counter counting words, the checks do not need the tiktoken encodings
+    """
+
+    def count_message(self, message: dict) -> int:
+        return len(message['content'].split()) + 4
+
+    def count_messages(self, messages: list) -> int:
+        return sum(message.get('tokens') or self.count_message(message) for message in messages) + 2
+
+    async def annotate(self, data: dict):
+        for message in data['history']:
+            message.setdefault('tokens', self.count_message(message))
+        data['tokens'] = sum(message['tokens'] for message in data['history'])
+
+    async def append(self, data: dict, role: str, content: str):
+        message = {"role": role, "content": content}
+        message['tokens'] = self.count_message(message)
+        data['history'].append(message)
+        data['tokens'] += message['tokens']
+
+    def evict(self, data: dict, index: int):
+        message = data['history'].pop(index)
+        data['tokens'] -= message['tokens']
+        return message
+
+    @staticmethod
+    def strip(messages: list) -> list:
+        return [{key: message[key] for key in ('role', 'content')} for message in messages]
+
+
+class MemoryHistory:
+    """
+    History store keeping the chats in a dictionary
+    """
+
+    def __init__(self):
+        self.chats = {}
+
+    async def get(self, chat_id):
+        return self.chats[str(chat_id)]
+
+    def set(self, chat_id, data: dict):
+        self.chats[str(chat_id)] = data
+
+    @asynccontextmanager
+    async def turn(self, chat_id):
+        yield
+
+
+@check
+async def hybrid_context_batches_summaries():
+    """
+    A full window is trimmed to the low-water mark, the summary is not requested on every turn
+    """
+    calls = []
+
+    async def summarise(conversation: list):
+        calls.append(conversation)
+        return 'summary'
+
+    history, counter = MemoryHistory(), WordCounter()
+    context = ContextManager({'context_strategy': 'hybrid', 'context_low_water': 0.75,
+                              'max_all_tokens': 1200, 'max_tokens': 200}, history, counter, summarise)
+    data = {'history': [{"role": "system", "content": "You are a helpful assistant."}]}
+    await counter.annotate(data)
+    history.set(42, data)
+    for turn in range(60):
+        data = await history.get(42)
+        await counter.append(data, 'user', f'question {turn} ' + 'word ' * 15)
+        context.fit(42, data)
+        assert data['tokens'] <= context.budget
+        await counter.append(data, 'assistant', f'answer {turn} ' + 'word ' * 25)
+        context.refresh(42, data)
+        await asyncio.sleep(0)
+    await asyncio.sleep(0.01)
+    assert 0 < len(calls) <= 12, f'{len(calls)} summary requests in 60 turns'
+    assert not context._pending.get('42')
+
+
+class SlowBackend:
+    """
+    History backend keeping the chats in a dictionary, a save takes a while and may fail
+    """
+    shared = False
+
+    def __init__(self, delay: float = 0.05, errors: int = 0):
+        self.delay = delay
+        self.errors = errors
+        self.chats = {}
+        self.writing = threading.Event()
+
+    def exists(self, chat_id: str):
+        return chat_id in self.chats
+
+    def load(self, chat_id: str):
+        return self.chats[chat_id]
+
+    def save(self, chat_id: str, data: dict):
+        self.writing.set()
+        time.sleep(self.delay)
+        if self.errors:
+            self.errors -= 1
+            raise ValueError('unexpected save error')
+        self.chats[chat_id] = data
+
+
+def history_store(backend) -> HistoryStore:
+    offload = Offloader({'io_threads': 2, 'cpu_processes': 1, 'cpu_threshold': 20000, 'lag_threshold': 0.1})
+    return HistoryStore({'cache_size': 10, 'flush_interval': 0.01}, offload, backend)
+
+
+@check
+async def history_close_finishes_flush():
+    """
+    Closing the store during a periodic flush waits for the save instead of cancelling it
+    """
+    backend = SlowBackend(delay=0.2)
+    store = history_store(backend)
+    store.start()
+    store.set(1, {'history': [{"role": "user", "content": "first"}]})
+    while not backend.writing.is_set():
+        await asyncio.sleep(0.005)
+    store.set(1, {'history': [{"role": "user", "content": "second"}]})
+    await store.close()
+    assert backend.chats['1']['history'][0]['content'] == 'second', backend.chats
+    assert not store._dirty and store._flush_task is None
+
+
+@check
+async def history_flush_survives_errors():
+    """
+    An unexpected save error keeps the periodic flush running and the chat dirty
+    """
+    backend = SlowBackend(delay=0, errors=2)
+    store = history_store(backend)
+    store.start()
+    store.set(1, {'history': [{"role": "user", "content": "hello"}]})
+    for _ in range(100):
+        if '1' in backend.chats:
+            break
+        await asyncio.sleep(0.01)
+    assert '1' in backend.chats and not backend.errors
+    assert not store._flush_task.done()
+    await store.close()
+
+
+class FakeRedis:
+    """
+    In-process stand-in of the redis client calls used by the redis history backend
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.mutex = threading.Lock()
+
+    def __expire(self, key: str):
+        if key in self.expires and self.expires[key] <= time.monotonic():
+            del self.data[key], self.expires[key]
+
+    def get(self, key: str):
+        with self.mutex:
+            self.__expire(key)
+            return self.data.get(key)
+
+    def set(self, key: str, value, nx: bool = False, px: int = None):
+        value = value.encode() if isinstance(value, str) else value
+        with self.mutex:
+            self.__expire(key)
+            if nx and key in self.data:
+                return None
+            self.data[key] = value
+            self.expires.pop(key, None)
+            if px is not None:
+                self.expires[key] = time.monotonic() + px / 1000
+            return True
+
+    def delete(self, key: str, token: bytes = None):
+        with self.mutex:
+            self.__expire(key)
+            if key not in self.data or token is not None and self.data[key] != token:
+                return 0
+            del self.data[key]
+            self.expires.pop(key, None)
+            return 1
+
+    def exists(self, key: str):
+        with self.mutex:
+            self.__expire(key)
+            return int(key in self.data)
+
+    def scan_iter(self, match: str = '*'):
+        with self.mutex:
+            keys = [key for key in self.data if fnmatch.fnmatchcase(key, match)]
+        for key in keys:
+            if self.exists(key):
+                yield key.encode()
+
+    def lock(self, name: str, timeout: float = None, thread_local: bool = True):
+        return FakeRedisLock(self, name, timeout)
+
+
+class FakeRedisLock:
+    """
+    Lock of the fake redis client, a token in a key that expires after the timeout
+    """
+
+    def __init__(self, client: FakeRedis, name: str, timeout: float = None):
+        self.client = client
+        self.name = name
+        self.timeout = timeout
+        self.token = None
+
+    def acquire(self, blocking: bool = True):
+        token = f'{id(self)}:{time.monotonic()}'.encode()
+        px = None if self.timeout is None else int(self.timeout * 1000)
+        while not self.client.set(self.name, token, nx=True, px=px):
+            if not blocking:
+                return False
+            time.sleep(0.001)
+        self.token = token
+        return True
+
+    def release(self):
+        token, self.token = self.token, None
+        if token is None or not self.client.delete(self.name, token):
+            raise RuntimeError(f'Cannot release the lock {self.name}, it is not owned or has expired')
+
+
+@check
+def redis_backend_round_trip():
+    """
+    The redis backend saves, loads and lists the chats and a chat lock is held by one worker at a time
+    """
+    backend = RedisBackend('redis://fake', lock_timeout=0.05, client=FakeRedis())
+    assert not backend.exists('1')
+    backend.save('1', {'history': [{"role": "user", "content": "привет"}]})
+    backend.save('2', {'history': []})
+    assert backend.exists('1') and backend.load('1')['history'][0]['content'] == 'привет'
+    assert sorted(backend.chat_ids()) == ['1', '2']
+    try:
+        backend.load('3')
+    except KeyError:
+        pass
+    else:
+        raise AssertionError('a missing chat is loaded')
+
+    first, second = backend.lock('1'), backend.lock('1')
+    assert first.acquire(blocking=False)
+    assert not second.acquire(blocking=False)
+    assert backend.lock('2').acquire(blocking=False)
+    first.release()
+    assert second.acquire(blocking=False)
+    # the lock of a crashed worker expires
+    time.sleep(0.06)
+    assert first.acquire(blocking=False)
+    first.release()
+
+
+@check
+async def redis_history_turns_are_serialised():
+    """
+    Two stores sharing a redis backend do not lose the messages of concurrent turns of one chat
+    """
+    backend = RedisBackend('redis://fake', lock_timeout=5, client=FakeRedis())
+    backend.save('1', {'history': []})
+    stores = [history_store(backend), history_store(backend)]
+
+    async def turn(store: HistoryStore, n: int):
+        async with store.turn(1):
+            data = await store.get(1)
+            await asyncio.sleep(0.001)
+            data['history'].append({"role": "user", "content": str(n)})
+            store.set(1, data)
+
+    await asyncio.gather(*(turn(stores[n % 2], n) for n in range(20)))
+    for store in stores:
+        await store.close()
+    assert sorted(int(message['content']) for message in backend.load('1')['history']) == list(range(20))
+
+
+@check
+def voicing_routes_list_answers():
+    """
+    List-shaped answers are voiced in one language, a language switch needs a long paragraph in another alphabet
+    """
+    from voicing import split_languages  # needs torch and the speech dependencies
+
+    languages = {'ru': None, 'en': None}
+    english = 'Here are some tips:\n1. Drink water\n2. Sleep 8h\n- Walk\n\n```\npip install x\n```\nGood luck!'
+    assert [language for language, text in split_languages(english, languages)] == ['en']
+    russian = 'Вот несколько советов:\n1. Пейте воду\n2. Спите 8 часов\n- Используйте Python 3\n- OK\n\nУдачи!'
+    assert [language for language, text in split_languages(russian, languages)] == ['ru']
+    # short lines in another language stay in the run of the surrounding text
+    mixed = 'Переводы:\n- hello: привет\n- Thank you very much\n- спасибо большое\n- Good night\n- Спокойной ночи'
+    assert [language for language, text in split_languages(mixed, languages)] == ['ru']
+    quote = ('Вот цитата из книги, которую вы просили найти в оригинале и прочитать вслух целиком:\n'
+             'It was the best of times, it was the worst of times, '
+             'it was the age of wisdom, it was the age of foolishness.\n'
+             '1. Автор: Чарльз Диккенс')
+    runs = split_languages(quote, languages)
+    assert [language for language, text in runs] == ['ru', 'en', 'ru'], runs
+    assert '\n'.join(text for language, text in runs) == quote
+    assert split_languages('42\n```\n1 + 1\n```', languages) == []
+
+
+@check
+async def speech_jobs_fit_the_free_queue():
+    """
+    A message with more chunks than the queue holds is voiced in order, it is rejected only by the work of others
+    """
+    from speech import SpeechQueueFull
+    from voicing import OrderedJobs, SpeechWorkers  # needs torch and the speech dependencies
+
+    workers = SpeechWorkers({'tts_threads': 1, 'tts_workers': 1, 'tts_queue_size': 1})
+    release = threading.Event()
+    try:
+        jobs = OrderedJobs(workers, lambda n: time.sleep(0.001) or n, [(n,) for n in range(7)])
+        assert [await jobs.next() for _ in range(7)] == list(range(7))
+
+        others = workers.submit(release.wait, (), ())
+        try:
+            OrderedJobs(workers, str, [(1,), (2,)])
+        except SpeechQueueFull:
+            pass
+        else:
+            raise AssertionError('a message is admitted into a full queue')
+        release.set()
+        await asyncio.gather(*others)
+
+        others = workers.submit(time.sleep, (0.05,))
+        jobs = OrderedJobs(workers, str, [(n,) for n in range(5)])
+        assert [await jobs.next() for _ in range(5)] == [str(n) for n in range(5)]
+        await asyncio.gather(*others)
+        assert workers.depth == 0
+    finally:
+        release.set()
+        workers.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline checks of the bot parts that need no Telegram or OpenAI')
+    parser.add_argument('names', nargs='*', help='checks to run, all by default')
+    args = parser.parse_args()
+
+    failed = 0
+    for func in CHECKS:
+        if args.names and func.__name__ not in args.names:
+            continue
+        try:
+            result = func()
+            if asyncio.iscoroutine(result):
+                asyncio.run(result)
+        except Exception:
+            failed += 1
+            print(f'FAIL {func.__name__}')
+            traceback.print_exc()
+        else:
+            print(f'ok   {func.__name__}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+
+from history import HistoryStore
+from tokens import TokenCounter
+
+STRATEGIES = ('window', 'summary', 'hybrid')
+
+
+class ContextManager:
+
+    def __init__(self, config: dict, history: HistoryStore, counter: TokenCounter, summarise):
+        """
+        Keeping the chat context within the model limits without blocking the user request
+        :param config: dictionary with openai configurations
+        :param history: chat history store
+        :param counter: token counter of the chat model
+        :param summarise: coroutine function summarising a list of messages
+        """
+        if config['context_strategy'] not in STRATEGIES:
+            raise ValueError(f"Unknown context strategy {config['context_strategy']}, use one of {STRATEGIES}")
+        self.strategy = config['context_strategy']
+        self.budget = config['max_all_tokens'] - config['max_tokens'] - 2
+        # a full history is trimmed well below the budget, one summary request covers several turns
+        self.low_water = int(self.budget * config['context_low_water'])
+        self.history = history
+        self.counter = counter
+        self._summarise = summarise
+        self._pending = {}
+        self._tasks = {}
+
+    def fit(self, chat_id: str, data: dict) -> list:
+        """
+        Getting the messages to send so that the request fits into the context window
+        :param chat_id: Telegram chat id
+        :param data: Data with chat history
+        :return: list of messages for the request
+        """
+        chat_id = str(chat_id)
+        if data['tokens'] <= self.budget:
+            return data['history']
+
+        if self.strategy == 'summary':
+            # the stored history is folded into the summary later, only the request is trimmed
+            messages = list(data['history'])
+            tokens = data['tokens']
+            while tokens > self.budget and len(messages) > self.__first_turn(messages) + 1:
+                tokens -= messages.pop(self.__first_turn(messages))['tokens']
+            return messages
+
+        dropped = []
+        while data['tokens'] > self.low_water and len(data['history']) > self.__first_turn(data['history']) + 1:
+            dropped.append(self.counter.evict(data, self.__first_turn(data['history'])))
+        logging.info(f"{len(dropped)} old messages were dropped from the context (id: {chat_id})")
+        if self.strategy == 'hybrid':
+            self._pending.setdefault(chat_id, []).extend(dropped)
+        return data['history']
+
+    def refresh(self, chat_id: str, data: dict):
+        """
+        Scheduling the background summary update after the reply has been sent
+        :param chat_id: Telegram chat id
+        :param data: Data with chat history
+        """
+        chat_id = str(chat_id)
+        if self.strategy == 'window' or chat_id in self._tasks:
+            return
+        if self.strategy == 'summary' and data['tokens'] <= self.budget:
+            return
+        if self.strategy == 'hybrid' and not self._pending.get(chat_id):
+            return
+        task = asyncio.create_task(self.__refresh(chat_id))
+        self._tasks[chat_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(chat_id, None))
+
+    def reset(self, chat_id: str):
+        """
+        Forgetting the pending summary work after the history was cleared
+        :param chat_id: Telegram chat id
+        """
+        chat_id = str(chat_id)
+        self._pending.pop(chat_id, None)
+        task = self._tasks.pop(chat_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def __refresh(self, chat_id: str):
+        data = await self.history.get(chat_id)
+        if self.strategy == 'summary':
+            # everything except the system message, the summary and the last turn
+            folded = data['history'][self.__first_turn(data['history']):-2]
+        else:
+            folded = self._pending.pop(chat_id, [])
+        if not folded:
+            return
+        summary = self.__summary(data)
+        conversation = ([summary] if summary else []) + folded
+        try:
+            text = await self._summarise(self.counter.strip(conversation))
+        except Exception as e:
+            logging.error(f'Failed to refresh the conversation summary (id: {chat_id}): {e}')
+            return
+
+        async with self.history.turn(chat_id):
+            data = await self.history.get(chat_id)
+            messages = data['history']
+            start = self.__first_turn(messages)
+            if self.strategy == 'summary':
+                # the folded turns are the head of the history unless it was cleared or folded meanwhile,
+                # a shared backend reloads them as new objects so the head is checked by position
+                head = messages[start:start + len(folded)]
+                if [(message['role'], message['content']) for message in head] != \
+                        [(message['role'], message['content']) for message in folded]:
+                    logging.info(f"The history changed during the summary refresh, it is skipped (id: {chat_id})")
+                    return
+                start += len(folded)
+            data['history'] = [messages[0],
+                               {"role": "system", "content": f"Summary of the earlier conversation: {text}",
+                                "summary": True}] + messages[start:]
+            await self.counter.annotate(data)
+            self.history.set(chat_id, data)
+        logging.info(f"The conversation summary was refreshed (id: {chat_id})")
+
+    @staticmethod
+    def __summary(data: dict):
+        for message in data['history'][1:2]:
+            if message.get('summary'):
+                return message
+
+    def __first_turn(self, messages: list) -> int:
+        """
+        Index of the first message that can be dropped, the system message and the summary are pinned
+        """
+        return 2 if len(messages) > 1 and messages[1].get('summary') else 1
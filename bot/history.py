@@ -0,0 +1,196 @@
+import asyncio
+import functools
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from metrics import HISTORY_IO
+from offload import Offloader
+from storage import JsonFileBackend
+
+LOCK_RETRY = 0.01
+LOCK_RETRY_MAX = 0.5
+
+
+class HistoryStore:
+
+    def __init__(self, config: dict, offload: Offloader, backend=None):
+        """
+        In-memory write-back cache of chat histories
+        :param config: dictionary with history store configurations
+        :param offload: executor of the blocking backend calls
+        :param backend: object persisting the histories, JSON files by default
+        """
+        self.backend = backend or JsonFileBackend()
+        self.offload = offload
+        self.max_chats = config['cache_size']
+        self.flush_interval = config['flush_interval']
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._evicted = {}
+        self._loading = {}
+        self._flush_task = None
+        self._flushing = asyncio.Lock()
+        self._closing = asyncio.Event()
+
+    async def exists(self, chat_id: str):
+        chat_id = str(chat_id)
+        if chat_id in self._cache or chat_id in self._evicted:
+            return True
+        return await self.offload.run_io(self.backend.exists, chat_id)
+
+    async def get(self, chat_id: str):
+        """
+        Getting the chat data, loading it from the backend on a cache miss
+        :param chat_id: Telegram chat id
+        :return: dict with chat history
+        """
+        chat_id = str(chat_id)
+        if chat_id in self._cache:
+            self._cache.move_to_end(chat_id)
+            return self._cache[chat_id]
+        if chat_id in self._evicted:
+            # not written yet, the backend copy is stale
+            self.set(chat_id, self._evicted.pop(chat_id))
+            return self._cache[chat_id]
+        if chat_id not in self._loading:
+            self._loading[chat_id] = asyncio.ensure_future(self.offload.run_io(self.__load, chat_id))
+        try:
+            data = await self._loading[chat_id]
+        finally:
+            self._loading.pop(chat_id, None)
+        if chat_id not in self._cache:
+            self._put(chat_id, data)
+        return self._cache[chat_id]
+
+    def set(self, chat_id: str, data: dict):
+        """
+        Replacing the chat data and marking it for the next flush
+        :param chat_id: Telegram chat id
+        :param data: Data with chat history
+        """
+        chat_id = str(chat_id)
+        self._put(chat_id, data)
+        self._dirty.add(chat_id)
+
+    def _put(self, chat_id: str, data: dict):
+        self._cache[chat_id] = data
+        self._cache.move_to_end(chat_id)
+        while len(self._cache) > self.max_chats:
+            old_id, old_data = self._cache.popitem(last=False)
+            if old_id in self._dirty:
+                self._dirty.discard(old_id)
+                self._evicted[old_id] = old_data
+
+    @asynccontextmanager
+    async def turn(self, chat_id: str):
+        """
+        Holding the chat for a read-modify-write when the backend is shared by several workers,
+        the chat is reloaded before and written right after
+        :param chat_id: Telegram chat id
+        """
+        if not self.backend.shared:
+            yield
+            return
+        chat_id = str(chat_id)
+        lock = self.backend.lock(chat_id)
+        await self.__acquire(lock)
+        try:
+            # another worker may have changed the chat since it was cached
+            self._cache.pop(chat_id, None)
+            self._dirty.discard(chat_id)
+            yield
+            data = self._cache.get(chat_id) if chat_id in self._dirty else self._evicted.pop(chat_id, None)
+            if data is not None:
+                self._dirty.discard(chat_id)
+                await self.offload.run_io(self.__save, chat_id, self.__snapshot(data))
+        finally:
+            await self.offload.run_io(lock.release)
+
+    async def flush(self):
+        """
+        Writing all changed histories to the backend
+        """
+        # one batch at a time, two writers of the same chat would race on its file
+        async with self._flushing:
+            if not self._dirty and not self._evicted:
+                return
+            dirty, self._dirty = self._dirty, set()
+            # the loop keeps mutating cached histories while the batch is being written
+            batch = [(chat_id, self.__snapshot(self._cache[chat_id])) for chat_id in dirty if chat_id in self._cache]
+            evicted = list(self._evicted.items())
+            batch.extend((chat_id, self.__snapshot(data)) for chat_id, data in evicted)
+            try:
+                failed = await self.offload.run_io(self.__save_batch, batch)
+            except BaseException:
+                # the batch is written again on the next flush, the evicted chats are still kept
+                self._dirty.update(chat_id for chat_id in dirty if chat_id in self._cache)
+                raise
+            for chat_id, data in evicted:
+                if self._evicted.get(chat_id) is data and chat_id not in failed:
+                    del self._evicted[chat_id]
+            self._dirty.update(chat_id for chat_id in failed if chat_id in self._cache)
+
+    def __load(self, chat_id: str):
+        with HISTORY_IO.time(operation='load'):
+            return self.backend.load(chat_id)
+
+    def __save(self, chat_id: str, data: dict):
+        with HISTORY_IO.time(operation='save'):
+            self.backend.save(chat_id, data)
+
+    async def __acquire(self, lock):
+        """
+        Waiting for the chat lock without holding a thread of the I/O pool, the lock holder needs the pool to
+        save the chat and release the lock
+        """
+        delay = LOCK_RETRY
+        with HISTORY_IO.time(operation='lock'):
+            while not await self.offload.run_io(functools.partial(lock.acquire, blocking=False)):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, LOCK_RETRY_MAX)
+
+    @staticmethod
+    def __snapshot(data: dict):
+        return {**data, 'history': [dict(message) for message in data['history']]}
+
+    def __save_batch(self, batch: list):
+        failed = set()
+        for chat_id, data in batch:
+            try:
+                self.__save(chat_id, data)
+            except OSError as e:
+                logging.error(f'Failed to save history (id: {chat_id}): {e}')
+                failed.add(chat_id)
+        return failed
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._closing.wait(), self.flush_interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.exception(f'Failed to flush the histories, they are written on the next flush: {e}')
+
+    def start(self):
+        """
+        Starting the periodic flush in the running event loop
+        """
+        if self._flush_task is None:
+            self._closing.clear()
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """
+        Stopping the periodic flush and writing the remaining changes
+        """
+        if self._flush_task is not None:
+            # a flush in progress is finished, its thread would keep writing after a cancel
+            self._closing.set()
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
@@ -4,9 +4,16 @@ import os
 from dotenv import load_dotenv
 from telegram_bot import TelegramBot
 from chatai import GPT
-from voicing import Announcer
+from history import HistoryStore
+from metrics import TraceFilter
+from offload import Offloader
+from storage import create_backend
+from openai_client import OpenAIClient
+from speech import SpeechService
 from openai import api_base
 
+FOLDERS = ['audio', 'history', 'log', 'models', 'voice']
+
 
 def check_folders(folders: list):
     """
@@ -27,14 +34,15 @@ def main():
     load_dotenv()
 
     # Check missing folders
-    folders = ['audio', 'history', 'log', 'models', 'voice']
-    missing_folder = check_folders(folders)
+    missing_folder = check_folders(FOLDERS)
 
     # Setup logging
     file_log = logging.FileHandler('log/chat.log')
     console_out = logging.StreamHandler()
-    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO,
-                        handlers=(file_log, console_out))
+    for handler in (file_log, console_out):
+        handler.addFilter(TraceFilter())
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s',
+                        level=logging.INFO, handlers=(file_log, console_out))
 
     if len(missing_folder) > 0:
         logging.info(f'These folders {", ".join(missing_folder)} were missing and were successfully created')
@@ -46,35 +54,111 @@ def main():
         logging.error(f'The following environment values are missing in your .env: {", ".join(missing_values)}')
         exit(1)
 
-    # Setup configurations
+    telegram_bot = build_bot(configure())
+    telegram_bot.run()
+
+
+def configure():
+    """
+    Reading the configurations from the environment
+    :return: dictionary with the configurations of every part of the bot
+    """
     openai_config = {"token_openai": os.environ['TOKEN_OPENAI'],
                      'proxy': os.environ.get('PROXY', None),
                      'model': os.environ.get('MODEL', 'gpt-3.5-turbo-0301'),
                      'base_api': os.environ.get('BASE_API', api_base),
                      'image_size': os.environ.get('IMAGE_SIZE', '512x512'),
+                     'transcode_audio': os.environ.get('TRANSCODE_AUDIO', 'false').lower() == "true",
+                     'keep_audio': os.environ.get('KEEP_AUDIO', 'false').lower() == "true",
                      'max_tokens': int(os.environ.get('MAX_TOKENS', 1200)),
                      'max_all_tokens': int(os.environ.get('MAX_ALL_TOKENS', 4097)),
+                     'context_strategy': os.environ.get('CONTEXT_STRATEGY', 'hybrid'),
+                     'context_low_water': float(os.environ.get('CONTEXT_LOW_WATER', 0.75)),
                      'temperature': float(os.environ.get('TEMPERATURE', 1.0)),
                      'presence_penalty': float(os.environ.get('PRESENCE_PENALTY', 0.0)),
                      'frequency_penalty': float(os.environ.get('FREQUENCY_PENALTY', 0.0)),
+                     'pool_size': int(os.environ.get('OPENAI_POOL_SIZE', 100)),
+                     'max_concurrency': int(os.environ.get('OPENAI_MAX_CONCURRENCY', 50)),
+                     'rpm': int(os.environ.get('OPENAI_RPM', 3500)),
+                     'tpm': int(os.environ.get('OPENAI_TPM', 90000)),
+                     'queue_size': int(os.environ.get('OPENAI_QUEUE_SIZE', 100)),
+                     'max_retries': int(os.environ.get('OPENAI_MAX_RETRIES', 3)),
+                     'request_timeout': float(os.environ.get('OPENAI_TIMEOUT', 60.0)),
+                     'response_cache': os.environ.get('RESPONSE_CACHE', 'off').lower(),
+                     'response_cache_size': int(os.environ.get('RESPONSE_CACHE_SIZE', 1000)),
+                     'response_cache_ttl': float(os.environ.get('RESPONSE_CACHE_TTL', 3600.0)),
                      }
 
     telegram_config = {'token_bot': os.environ['TOKEN_TELEGRAM'],
                        'allowed_user_ids': os.environ.get('ALLOWED_TELEGRAM_USER_IDS', '*'),
-                       'stream': os.environ.get('STREAM', 'true').lower() == "true"}
+                       'allowed_users_file': os.environ.get('ALLOWED_USERS_FILE'),
+                       'stream': os.environ.get('STREAM', 'true').lower() == "true",
+                       'coalesce_window': float(os.environ.get('COALESCE_WINDOW', 0.0)),
+                       'edit_interval': float(os.environ.get('EDIT_INTERVAL', 1.0)),
+                       'edit_min_chars': int(os.environ.get('EDIT_MIN_CHARS', 40)),
+                       'chat_rate': float(os.environ.get('CHAT_RATE', 1.0)),
+                       'global_rate': float(os.environ.get('GLOBAL_RATE', 30.0)),
+                       'webhook_url': os.environ.get('WEBHOOK_URL'),
+                       'webhook_path': os.environ.get('WEBHOOK_PATH', '/webhook'),
+                       'webhook_host': os.environ.get('WEBHOOK_HOST', '0.0.0.0'),
+                       'webhook_port': int(os.environ.get('WEBHOOK_PORT', 8080)),
+                       'webhook_secret': os.environ.get('WEBHOOK_SECRET'),
+                       'drain_timeout': float(os.environ.get('DRAIN_TIMEOUT', 30.0)),
+                       'telegram_api': os.environ.get('TELEGRAM_API_SERVER'),
+                       'metrics_host': os.environ.get('METRICS_HOST', '127.0.0.1'),
+                       'metrics_port': int(os.environ.get('METRICS_PORT', 0))}
+
+    history_config = {'cache_size': int(os.environ.get('HISTORY_CACHE_SIZE', 1000)),
+                      'flush_interval': float(os.environ.get('HISTORY_FLUSH_INTERVAL', 5.0)),
+                      'backend': os.environ.get('HISTORY_BACKEND', 'jsonl'),
+                      'fsync': os.environ.get('HISTORY_FSYNC', 'compaction'),
+                      'sqlite_path': os.environ.get('HISTORY_SQLITE_PATH', 'history/history.db'),
+                      'redis_url': os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+                      'lock_timeout': float(os.environ.get('HISTORY_LOCK_TIMEOUT', 300.0)),
+                      }
+
+    offload_config = {'io_threads': int(os.environ.get('IO_THREADS', 8)),
+                      'cpu_processes': int(os.environ.get('CPU_PROCESSES', 2)),
+                      'cpu_threshold': int(os.environ.get('CPU_THRESHOLD', 20000)),
+                      'lag_threshold': float(os.environ.get('LAG_THRESHOLD', 0.1)),
+                      }
 
     voicing_config = {'ru_model_speech': os.environ.get('RU_MODEL_SPEECH', 'ru_v3.pt'),
                       'en_model_speech': os.environ.get('EN_MODEL_SPEECH', 'v3_en.pt'),
                       'ru_speaker': os.environ.get('RU_SPEAKER', 'baya'),
                       'en_speaker': os.environ.get('EN_SPEAKER', 'en_1'),
                       'sample_rate': int(os.environ.get('SAMPLE_RATE', 48000)),
-                      'device': os.environ.get('DEVICE', 'cpu')
+                      'device': os.environ.get('DEVICE', 'cpu'),
+                      'tts_workers': int(os.environ.get('TTS_WORKERS', 0)),
+                      'tts_threads': int(os.environ.get('TTS_THREADS', 4)),
+                      'tts_queue_size': int(os.environ.get('TTS_QUEUE_SIZE', 8)),
+                      'tts_startup': os.environ.get('TTS_STARTUP', 'background').lower(),
+                      'voice_cache_memory': int(os.environ.get('VOICE_CACHE_MEMORY', 32)) * 1024 * 1024,
+                      'voice_cache_disk': int(os.environ.get('VOICE_CACHE_DISK', 256)) * 1024 * 1024,
                       }
+    telegram_config['redis_url'] = history_config['redis_url'] if history_config['backend'] == 'redis' else None
+    # a chat is locked for the whole turn, the lock must not expire while its answer is still streamed
+    turn_timeout = openai_config['request_timeout'] * (openai_config['max_retries'] + 1)
+    if history_config['backend'] == 'redis' and history_config['lock_timeout'] <= turn_timeout:
+        raise ValueError(f"HISTORY_LOCK_TIMEOUT must be longer than OPENAI_TIMEOUT * (OPENAI_MAX_RETRIES + 1), "
+                         f"{turn_timeout:.0f}s")
 
-    openai_chat = GPT(config=openai_config)
-    announcer = Announcer(config=voicing_config)
-    telegram_bot = TelegramBot(config=telegram_config, gpt=openai_chat, announcer=announcer)
-    telegram_bot.run()
+    return {'openai': openai_config, 'telegram': telegram_config, 'history': history_config,
+            'offload': offload_config, 'voicing': voicing_config}
+
+
+def build_bot(configs: dict):
+    """
+    Creating the bot and its services
+    :param configs: dictionary returned by configure
+    :return: TelegramBot object
+    """
+    offload = Offloader(config=configs['offload'])
+    history = HistoryStore(config=configs['history'], offload=offload, backend=create_backend(configs['history']))
+    openai_client = OpenAIClient(config=configs['openai'])
+    openai_chat = GPT(config=configs['openai'], history=history, client=openai_client, offload=offload)
+    speech = SpeechService(config=configs['voicing'])
+    return TelegramBot(config=configs['telegram'], gpt=openai_chat, speech=speech)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,157 @@
+import bisect
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+REGISTRY = []
+
+trace_id = ContextVar('trace_id', default='-')
+
+
+def new_trace() -> str:
+    """
+    Starting a trace of the update processed in the current context
+    :return: trace id shown in the log records
+    """
+    value = uuid.uuid4().hex[:12]
+    trace_id.set(value)
+    return value
+
+
+class TraceFilter(logging.Filter):
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id.get()
+        return True
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        """
+        Metric in the Prometheus text format, updated from the event loop and the worker threads
+        :param name: metric name
+        :param documentation: help text
+        :param labels: label names
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _labels(self, key: tuple, **extra) -> str:
+        pairs = list(zip(self.labels, key)) + list(extra.items())
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(f'{name}{labels} {value}' for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, self._labels(key), value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observing the duration of the block in seconds
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', self._labels(key, le=bound), cumulative
+            yield f'{self.name}_sum', self._labels(key), total
+            yield f'{self.name}_count', self._labels(key), cumulative
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+async def _metrics(request: web.Request):
+    return web.Response(text=render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def serve(host: str, port: int):
+    """
+    Starting the HTTP server of the /metrics endpoint
+    :return: the server runner, cleaned up when the bot stops
+    """
+    app = web.Application()
+    app.router.add_get('/metrics', _metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f'Metrics are served on http://{host}:{port}/metrics')
+    return runner
+
+
+OPENAI_LATENCY = Histogram('openai_request_seconds', 'Duration of the OpenAI requests', ('endpoint',))
+OPENAI_RETRIES = Counter('openai_retries_total', 'OpenAI requests retried after a transient error', ('endpoint',))
+OPENAI_TOKENS = Counter('openai_tokens_total', 'Tokens sent to and generated by the models', ('model', 'kind'))
+TIME_TO_FIRST_TOKEN = Histogram('chat_time_to_first_token_seconds',
+                                'Time from the message to the first streamed token', ('cached',))
+RESPONSE_CACHE = Counter('response_cache_requests_total', 'Response cache lookups', ('kind', 'result'))
+HISTORY_IO = Histogram('history_io_seconds', 'Duration of the history backend calls', ('operation',))
+TTS_MODEL_LOAD = Histogram('tts_model_load_seconds', 'Duration of loading the speech models', ('model',))
+TTS_INFERENCE = Histogram('tts_inference_seconds', 'Duration of the speech synthesis of one chunk', ('speaker',))
+TELEGRAM_EDIT = Histogram('telegram_edit_seconds', 'Duration of the message edits of streamed replies', ('kind',))
+TELEGRAM_RETRY_AFTER = Counter('telegram_retry_after_total', 'Telegram flood control errors', ('method',))
@@ -0,0 +1,49 @@
+import logging
+import os
+
+from dotenv import load_dotenv
+
+from storage import JsonFileBackend, create_backend
+
+
+def migrate(source, target):
+    """
+    Copying the chat histories between backends
+    :param source: backend to read from
+    :param target: backend to write to
+    :return: number of copied chats
+    """
+    count = 0
+    for chat_id in source.chat_ids():
+        lock = target.lock(chat_id)
+        lock.acquire()
+        try:
+            target.save(chat_id, source.load(chat_id))
+        finally:
+            lock.release()
+        count += 1
+    return count
+
+
+def main():
+    # Read .env file
+    load_dotenv()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    history_config = {'backend': os.environ.get('HISTORY_BACKEND', 'jsonl'),
+                      'fsync': os.environ.get('HISTORY_FSYNC', 'compaction'),
+                      'cache_size': int(os.environ.get('HISTORY_CACHE_SIZE', 1000)),
+                      'sqlite_path': os.environ.get('HISTORY_SQLITE_PATH', 'history/history.db'),
+                      'redis_url': os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+                      'lock_timeout': float(os.environ.get('HISTORY_LOCK_TIMEOUT', 300.0)),
+                      }
+    if history_config['backend'] == 'json':
+        logging.error('Set HISTORY_BACKEND to jsonl, sqlite or redis to import the history files')
+        exit(1)
+
+    count = migrate(JsonFileBackend(), create_backend(history_config))
+    logging.info(f'{count} chat histories were imported into the {history_config["backend"]} backend')
+
+
+if __name__ == '__main__':
+    main()
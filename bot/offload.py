@@ -0,0 +1,61 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class Offloader:
+
+    def __init__(self, config: dict):
+        """
+        Execution model of the bot: blocking I/O goes to a bounded thread pool,
+        heavy CPU work to a process pool, the event loop only schedules
+        :param config: dictionary with execution configurations
+        """
+        self.io_pool = ThreadPoolExecutor(max_workers=config['io_threads'], thread_name_prefix='io')
+        self.cpu_processes = config['cpu_processes']
+        self.cpu_threshold = config['cpu_threshold']
+        self.lag_threshold = config['lag_threshold']
+        self._cpu_pool = None
+        self._monitor = None
+
+    async def run_io(self, func, *args):
+        """
+        Running blocking I/O in the thread pool
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.io_pool, func, *args)
+
+    async def run_cpu(self, func, *args):
+        """
+        Running CPU-heavy work in the process pool, the function and arguments must be picklable
+        """
+        if self._cpu_pool is None:
+            self._cpu_pool = ProcessPoolExecutor(max_workers=self.cpu_processes)
+        return await asyncio.get_running_loop().run_in_executor(self._cpu_pool, func, *args)
+
+    def start(self):
+        """
+        Starting the event loop lag monitor
+        """
+        if self.lag_threshold > 0 and self._monitor is None:
+            self._monitor = asyncio.create_task(self.__monitor())
+
+    async def __monitor(self):
+        """
+        Logging the callbacks that block the event loop longer than the threshold
+        """
+        interval = self.lag_threshold / 2
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag = time.perf_counter() - started - interval
+            if lag > self.lag_threshold:
+                logging.warning(f'The event loop was blocked for {lag:.3f}s')
+
+    def shutdown(self):
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+        self.io_pool.shutdown(wait=True)
+        if self._cpu_pool is not None:
+            self._cpu_pool.shutdown(wait=True, cancel_futures=True)
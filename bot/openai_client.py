@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import time
+from contextvars import ContextVar
+
+import aiohttp
+import openai
+from openai.error import APIConnectionError, RateLimitError, ServiceUnavailableError, Timeout
+
+from metrics import OPENAI_LATENCY, OPENAI_RETRIES
+from scheduler import RequestScheduler
+
+RETRYABLE_ERRORS = (RateLimitError, ServiceUnavailableError, APIConnectionError, Timeout)
+
+
+class OpenAIClient:
+
+    def __init__(self, config: dict):
+        """
+        Shared keep-alive HTTP session and concurrency limit for the OpenAI requests
+        :param config: dictionary with openai configurations
+        """
+        self.pool_size = config['pool_size']
+        self.semaphore = asyncio.Semaphore(config['max_concurrency'])
+        self.scheduler = RequestScheduler(config)
+        self.session = None
+        self.latency = {}
+
+    async def start(self):
+        """
+        Creating the session, run when the bot starts
+        """
+        connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector)
+        # openai reads the session from this context variable on every request, a default value
+        # makes it visible to the update handlers that run in their own contexts
+        openai.aiosession = ContextVar('aiohttp-session', default=self.session)
+        logging.info(f'OpenAI session started with a pool of {self.pool_size} connections')
+
+    async def close(self):
+        """
+        Closing the session, run when the bot stops
+        """
+        if self.session is not None:
+            openai.aiosession = ContextVar('aiohttp-session', default=None)
+            await self.session.close()
+            self.session = None
+
+    async def call(self, endpoint: str, request, user=None, tokens: int = 0, **kwargs):
+        """
+        Sending the request within the quotas and the concurrency limit, retrying the transient errors
+        :param endpoint: endpoint name for the latency metrics
+        :param request: openai coroutine function
+        :param user: Telegram chat id of the request author
+        :param tokens: tokens the request may use
+        :return: the response, streamed responses hold the concurrency slot until they are read or closed
+        :raises QueueOverloaded: when too many requests are already waiting
+        """
+        model = kwargs.get('model', endpoint)
+        attempt = 0
+        while True:
+            await self.scheduler.acquire(user, model, tokens)
+            await self.semaphore.acquire()
+            started = time.perf_counter()
+            streaming = False
+            try:
+                response = await request(**kwargs)
+                if kwargs.get('stream'):
+                    # the stream keeps the connection after the headers, the slot and the latency last until it ends
+                    streaming = True
+                    return self.__stream(endpoint, response, started)
+                return response
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.scheduler.max_retries or not self.scheduler.retryable(e):
+                    raise
+                error, delay = e, self.scheduler.backoff(model, attempt, e)
+            finally:
+                if not streaming:
+                    self.__release(endpoint, started)
+            logging.warning(f'{endpoint} request failed ({error}), retrying in {delay:.1f}s')
+            OPENAI_RETRIES.inc(endpoint=endpoint)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def __stream(self, endpoint: str, response, started: float):
+        """
+        Passing the streamed chunks through, the request is finished when the stream is read or closed
+        """
+        try:
+            async for item in response:
+                yield item
+        finally:
+            try:
+                if hasattr(response, 'aclose'):
+                    await response.aclose()
+            finally:
+                self.__release(endpoint, started)
+
+    def __release(self, endpoint: str, started: float):
+        self.semaphore.release()
+        self.__observe(endpoint, time.perf_counter() - started)
+
+    def __observe(self, endpoint: str, seconds: float):
+        OPENAI_LATENCY.observe(seconds, endpoint=endpoint)
+        metrics = self.latency.setdefault(endpoint, {'count': 0, 'total': 0.0, 'max': 0.0})
+        metrics['count'] += 1
+        metrics['total'] += seconds
+        metrics['max'] = max(metrics['max'], seconds)
+
+    def stats(self):
+        """
+        Average and maximum latency of every endpoint
+        """
+        return {endpoint: {'count': metrics['count'],
+                           'avg': metrics['total'] / metrics['count'],
+                           'max': metrics['max']}
+                for endpoint, metrics in self.latency.items()}
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import time
+
+from aiogram import types
+from aiogram.utils.exceptions import RetryAfter, CantParseEntities, MessageNotModified
+
+from metrics import TELEGRAM_EDIT, TELEGRAM_RETRY_AFTER
+from token_bucket import TokenBucket
+
+
+class RenderScheduler:
+
+    def __init__(self, config: dict):
+        """
+        Scheduling message edits of streaming replies within the Telegram limits
+        :param config: dictionary with bot configurations
+        """
+        self.interval = config['edit_interval']
+        self.min_chars = config['edit_min_chars']
+        self.chat_rate = config['chat_rate']
+        self.global_bucket = TokenBucket(config['global_rate'])
+        self._chat_buckets = {}
+
+    def bucket(self, chat_id) -> TokenBucket:
+        if chat_id not in self._chat_buckets:
+            if len(self._chat_buckets) > 10000:
+                # idle chats have full buckets and can be recreated at any time
+                self._chat_buckets = {key: bucket for key, bucket in self._chat_buckets.items()
+                                      if not bucket.full()}
+            self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, capacity=max(1.0, self.chat_rate))
+        return self._chat_buckets[chat_id]
+
+    def try_acquire(self, chat_id) -> bool:
+        """
+        Taking a request slot without waiting
+        """
+        bucket = self.bucket(chat_id)
+        if not (self.global_bucket.ready() and bucket.ready()):
+            return False
+        self.global_bucket.try_acquire()
+        bucket.try_acquire()
+        return True
+
+    async def acquire(self, chat_id):
+        """
+        Waiting for a request slot in the global and the chat buckets
+        """
+        while not self.try_acquire(chat_id):
+            await asyncio.sleep(max(0.01, self.global_bucket.delay(), self.bucket(chat_id).delay()))
+
+    def flood_wait(self, chat_id, seconds: float):
+        logging.warning(f'Flood control for {seconds}s (id: {chat_id})')
+        TELEGRAM_RETRY_AFTER.inc(method='editMessageText')
+        self.bucket(chat_id).block(seconds)
+
+    def stream(self, chat_id, content: types.Message):
+        """
+        Creating the renderer of one streamed message
+        :param chat_id: Telegram chat id
+        :param content: the message being edited
+        """
+        return StreamRenderer(self, chat_id, content)
+
+
+class StreamRenderer:
+
+    def __init__(self, scheduler: RenderScheduler, chat_id, content: types.Message):
+        self.scheduler = scheduler
+        self.chat_id = chat_id
+        self.content = content
+        self.text = content.text
+        self.edited = 0.0
+
+    def due(self, length: int) -> bool:
+        """
+        Checking the edit interval without building the text
+        :param length: current length of the message text
+        """
+        elapsed = time.monotonic() - self.edited
+        if elapsed < self.scheduler.interval:
+            return False
+        return length - len(self.text) >= self.scheduler.min_chars or elapsed >= 2 * self.scheduler.interval
+
+    async def update(self, text: str):
+        """
+        Editing the message with the intermediate text if it is due and the limits allow it
+        :param text: current text of the message
+        """
+        if text == self.text or not text.strip() or not self.due(len(text)):
+            return
+        if not self.scheduler.try_acquire(self.chat_id):
+            return
+        try:
+            with TELEGRAM_EDIT.time(kind='update'):
+                await self.content.edit_text(text)
+        except RetryAfter as e:
+            self.scheduler.flood_wait(self.chat_id, e.timeout)
+            return
+        except MessageNotModified:
+            pass
+        self.text = text
+        self.edited = time.monotonic()
+
+    async def finish(self, text: str, reply_markup=None):
+        """
+        Editing the message with the final text, waiting for the limits instead of skipping
+        :param text: final text of the message
+        :param reply_markup: keyboard attached to the final message
+        """
+        parse_mode = types.ParseMode.MARKDOWN
+        while True:
+            await self.scheduler.acquire(self.chat_id)
+            try:
+                with TELEGRAM_EDIT.time(kind='final'):
+                    await self.content.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+            except RetryAfter as e:
+                self.scheduler.flood_wait(self.chat_id, e.timeout)
+                continue
+            except CantParseEntities:
+                parse_mode = None
+                continue
+            except MessageNotModified:
+                pass
+            break
+        self.text = text
+        self.edited = time.monotonic()
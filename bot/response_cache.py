@@ -0,0 +1,69 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+MODES = ('off', 'auto', 'on')
+
+
+class ResponseCache:
+
+    def __init__(self, config: dict):
+        """
+        LRU cache with expiration of model answers and generated images
+        :param config: dictionary with openai configurations
+        """
+        if config['response_cache'] not in MODES:
+            raise ValueError(f"Unknown response cache mode {config['response_cache']}, use one of {MODES}")
+        self.mode = config['response_cache']
+        self.max_size = config['response_cache_size']
+        self.ttl = config['response_cache_ttl']
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self, temperature: float = 0.0) -> bool:
+        """
+        The cache is used for deterministic requests in the auto mode and for all requests when it is on
+        """
+        return self.mode == 'on' or (self.mode == 'auto' and temperature == 0)
+
+    @staticmethod
+    def key(**params) -> str:
+        """
+        Hash of the normalised request parameters
+        """
+        return hashlib.sha256(json.dumps(params, sort_keys=True, ensure_ascii=False).encode('UTF8')).hexdigest()
+
+    @staticmethod
+    def normalise(messages: list) -> list:
+        return [{key: ' '.join(value.split()) for key, value in message.items()} for message in messages]
+
+    def get(self, key: str):
+        """
+        Getting the cached value
+        :return: the value or None when it is missing or expired
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, value, ttl: float = None):
+        """
+        Saving the value
+        :param ttl: seconds the value is valid, the configured TTL by default
+        """
+        self._entries[key] = (time.monotonic() + min(ttl or self.ttl, self.ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries),
+                'hit_rate': self.hits / total if total else 0.0}
@@ -0,0 +1,113 @@
+import asyncio
+import random
+from collections import OrderedDict, deque
+
+from openai.error import RateLimitError
+
+from token_bucket import TokenBucket
+
+
+class QueueOverloaded(Exception):
+    pass
+
+
+class RequestScheduler:
+
+    def __init__(self, config: dict):
+        """
+        Keeping the upstream requests within the requests and tokens per minute quotas
+        :param config: dictionary with openai configurations
+        """
+        self.rpm = config['rpm']
+        self.tpm = config['tpm']
+        self.max_queue = config['queue_size']
+        self.max_retries = config['max_retries']
+        self._quotas = {}
+        self._queues = OrderedDict()
+        self._size = 0
+        self._dispatcher = None
+        self._wakeup = asyncio.Event()
+
+    def quota(self, model: str):
+        """
+        Requests and tokens buckets of the model
+        """
+        if model not in self._quotas:
+            self._quotas[model] = (TokenBucket(self.rpm / 60, capacity=self.rpm),
+                                   TokenBucket(self.tpm / 60, capacity=self.tpm))
+        return self._quotas[model]
+
+    async def acquire(self, user, model: str, tokens: int = 0):
+        """
+        Waiting for the turn of the request, users are served in turn
+        :param user: Telegram chat id of the request author
+        :param model: OpenAI model of the request
+        :param tokens: tokens the request may use
+        :raises QueueOverloaded: when too many requests are already waiting
+        """
+        if self._size >= self.max_queue:
+            raise QueueOverloaded('Too many requests are waiting for the model, try again later')
+        turn = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user, deque()).append((model, tokens, turn))
+        self._size += 1
+        self._wakeup.set()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self.__dispatch())
+        await turn
+
+    async def __dispatch(self):
+        while self._queues:
+            delay = None
+            for user, queue in self._queues.items():
+                model, tokens, turn = queue[0]
+                requests, budget = self.quota(model)
+                tokens = min(tokens, budget.capacity)
+                if not turn.done() and not (requests.ready() and budget.ready(tokens)):
+                    # a model out of quota does not hold up the requests to the other models
+                    wait = max(0.01, requests.delay(), budget.delay(tokens))
+                    delay = wait if delay is None else min(delay, wait)
+                    continue
+                queue.popleft()
+                self._size -= 1
+                if not turn.done():
+                    requests.try_acquire()
+                    budget.try_acquire(tokens)
+                    turn.set_result(None)
+                # the next user gets the next request
+                self._queues.move_to_end(user)
+                if not queue:
+                    del self._queues[user]
+                break
+            else:
+                # a new request may be for a model that is ready
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    def backoff(self, model: str, attempt: int, error: Exception) -> float:
+        """
+        Delay before the next attempt, the server Retry-After wins over the jittered exponential backoff
+        :param model: OpenAI model of the request
+        :param attempt: number of the failed attempt starting from 0
+        :param error: the error of the attempt
+        :return: seconds to wait
+        """
+        delay = min(30.0, 2 ** attempt) * random.uniform(0.5, 1.5)
+        headers = getattr(error, 'headers', None) or {}
+        try:
+            delay = float(headers.get('retry-after', delay))
+        except (TypeError, ValueError):
+            pass
+        if isinstance(error, RateLimitError):
+            # nobody else gets this model until the server is ready again
+            self.quota(model)[0].block(delay)
+        return delay
+
+    @staticmethod
+    def retryable(error: Exception) -> bool:
+        return getattr(error, 'code', None) != 'insufficient_quota'
+
+    def depth(self) -> int:
+        return self._size
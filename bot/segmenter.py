@@ -0,0 +1,104 @@
+from stream import TextBuffer
+
+FENCE = '```'
+# boundaries from the most to the least preferred, the split happens after them
+BOUNDARIES = ('\n\n', '\n', '. ', '! ', '? ', '; ', ', ', ' ')
+
+
+class Segmenter:
+
+    def __init__(self, limit: int):
+        """
+        Incremental text splitter keeping its state between stream deltas
+        :param limit: maximum segment size in characters
+        """
+        self.limit = limit
+        self._buffer = TextBuffer()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    @property
+    def tail(self):
+        """
+        The text that is not yet closed into a segment
+        """
+        return self._buffer.text
+
+    def feed(self, delta: str) -> list:
+        """
+        Adding new text
+        :param delta: text received since the previous call
+        :return: list of segments closed by this text
+        """
+        self._buffer.append(delta)
+        if len(self._buffer) <= self.limit:
+            return []
+        # the deltas are joined only when a segment is closed, the rest of a long text is copied once
+        text = self._buffer.text
+        segments = []
+        start = 0
+        while True:
+            # a segment never starts with whitespace, a code block right after it is cut at the fence
+            while start < len(text) and text[start].isspace():
+                start += 1
+            if len(text) - start <= self.limit:
+                break
+            cut = self.__cut(text[start:start + self.limit])
+            segment = text[start:start + cut].rstrip()
+            if segment:
+                segments.append(segment)
+            start += cut
+        self._buffer.clear()
+        self._buffer.append(text[start:])
+        return segments
+
+    def close(self) -> list:
+        """
+        Closing the remaining text
+        :return: list with the last segment, empty if there is no text left
+        """
+        tail = self._buffer.text.strip()
+        self._buffer.clear()
+        return [tail] if tail else []
+
+    def __cut(self, text: str) -> int:
+        """
+        Position of the best boundary within the limit, outside Markdown code blocks if possible
+        """
+        window = text[:self.limit]
+        fence = self.__open_fence(window)
+        if fence > 0:
+            # the limit falls inside a code block, move the whole block to the next segment
+            return fence
+        for boundary in BOUNDARIES:
+            position = window.rfind(boundary)
+            if position > self.limit // 2:
+                return position + len(boundary)
+        return self.limit
+
+    @staticmethod
+    def __open_fence(text: str) -> int:
+        """
+        Position of the unclosed code block opening or -1
+        """
+        position = -1
+        start = text.find(FENCE)
+        while start != -1:
+            end = text.find(FENCE, start + len(FENCE))
+            if end == -1:
+                position = start
+                break
+            start = text.find(FENCE, end + len(FENCE))
+        return position
+
+
+def split_text(text: str, limit: int) -> list:
+    """
+    Splitting the whole text at sentence and Markdown block boundaries
+    :param text: text to split
+    :param limit: maximum segment size in characters
+    :return: list of segments
+    """
+    segmenter = Segmenter(limit)
+    return segmenter.feed(text) + segmenter.close()
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import time
+
+MODES = ('background', 'lazy', 'eager')
+
+
+class SpeechQueueFull(Exception):
+    pass
+
+
+class SpeechService:
+
+    def __init__(self, config: dict):
+        """
+        Starting the voicing without delaying the text chats: torch, langdetect and the speech
+        models are imported and loaded in the background
+        :param config: dictionary with voicing configurations
+        """
+        if config['tts_startup'] not in MODES:
+            raise ValueError(f"Unknown TTS startup mode {config['tts_startup']}, use one of {MODES}")
+        self.config = config
+        self.mode = config['tts_startup']
+        self.announcer = None
+        self.ready_time = None
+        self._task = None
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_time is not None
+
+    async def start(self):
+        """
+        Starting the warm-up according to the startup mode, run when the bot starts
+        """
+        if self.mode == 'background':
+            self.warm_up()
+        elif self.mode == 'eager':
+            await self.warm_up()
+
+    def warm_up(self):
+        """
+        Starting the warm-up if it is not running yet
+        :return: task finished when the voicing is ready
+        """
+        if self._task is None or (self._task.done() and not self.ready):
+            self._task = asyncio.create_task(self.__warm_up())
+        return self._task
+
+    async def __warm_up(self):
+        started = time.perf_counter()
+        try:
+            # the import pulls torch in and the constructor may download the models
+            self.announcer = await asyncio.to_thread(self.__create, self.config)
+            await self.announcer.warm_up()
+        except Exception as e:
+            logging.exception(f'Failed to warm up the voicing, it is retried on the next request: {e}')
+            return
+        self.ready_time = time.perf_counter() - started
+        logging.info(f'The voicing is ready in {self.ready_time:.1f}s')
+
+    @staticmethod
+    def __create(config: dict):
+        from voicing import Announcer
+        return Announcer(config)
+
+    async def shutdown(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self.announcer is not None:
+            self.announcer.workers.shutdown()
@@ -0,0 +1,362 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class NoLock:
+
+    def acquire(self, blocking=True):
+        return True
+
+    def release(self):
+        pass
+
+
+class FileLock:
+
+    def __init__(self, path: str):
+        """
+        Lock shared by the processes of one host
+        :param path: path to the lock file
+        """
+        self.path = path
+        self._file = None
+
+    def acquire(self, blocking=True):
+        """
+        Taking the lock
+        :param blocking: wait for the lock instead of failing right away
+        :return: True if the lock was taken
+        """
+        file = open(self.path, "a")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return False
+        self._file = file
+        return True
+
+    def release(self):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+class JsonFileBackend:
+    shared = False
+
+    def __init__(self, folder: str = 'history'):
+        self.folder = folder
+
+    def path(self, chat_id: str):
+        return f'{self.folder}/{chat_id}.json'
+
+    def exists(self, chat_id: str):
+        return os.path.isfile(self.path(chat_id))
+
+    def load(self, chat_id: str):
+        """
+        Read history file
+        :param chat_id: Telegram chat id
+        :return: dict with chat history
+        """
+        with open(self.path(chat_id), "r", encoding="UTF8") as file:
+            return json.load(file)
+
+    def save(self, chat_id: str, data: dict):
+        """
+        Writing to the history file
+        :param chat_id: Telegram chat id
+        :param data: Data with chat history
+        """
+        with open(self.path(chat_id), "w", encoding="UTF8") as file:
+            json.dump(data, file, indent=4)
+
+    def lock(self, chat_id: str):
+        return NoLock()
+
+    def chat_ids(self):
+        return [name[:-5] for name in os.listdir(self.folder) if name.endswith('.json')]
+
+
+class JsonLinesBackend:
+    shared = False
+    FSYNC = ('always', 'compaction', 'never')
+
+    def __init__(self, folder: str = 'history', fsync: str = 'compaction', cache_size: int = 1000):
+        """
+        Append-only per-chat logs of compact JSON records: the messages, the evictions of old messages
+        and the chat metadata. Other changes and logs with too many obsolete records are compacted
+        into a new file that atomically replaces the old one. The pretty-printed JSON files of
+        the json backend are migrated on first access.
+        :param folder: folder of the history files
+        :param fsync: when the files are synced to disk, after every write, after compactions or never
+        :param cache_size: number of chats whose last written state is kept to append the changes
+        """
+        if fsync not in self.FSYNC:
+            raise ValueError(f"Unknown fsync policy {fsync}, use one of {self.FSYNC}")
+        self.folder = folder
+        self.fsync = fsync
+        self.cache_size = cache_size
+        self.legacy = JsonFileBackend(folder)
+        # chat id -> (metadata, history, number of obsolete records) as it is on disk
+        self._written = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path(self, chat_id: str):
+        return f'{self.folder}/{chat_id}.jsonl'
+
+    def exists(self, chat_id: str):
+        return os.path.isfile(self.path(chat_id)) or self.legacy.exists(chat_id)
+
+    @staticmethod
+    def head_size(history: list) -> int:
+        """
+        Number of the pinned messages, the system message and the summaries, that are never evicted
+        """
+        size = min(1, len(history))
+        while size < len(history) and history[size].get('summary'):
+            size += 1
+        return size
+
+    @staticmethod
+    def record(value: dict) -> str:
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+    def load(self, chat_id: str):
+        """
+        Reading the history log record by record, the evicted messages are not kept in memory
+        :param chat_id: Telegram chat id
+        :return: dict with chat history
+        """
+        if not os.path.isfile(self.path(chat_id)) and self.legacy.exists(chat_id):
+            return self.__migrate(chat_id)
+
+        meta, head, tail = {}, [], deque()
+        obsolete, clean = 0, True
+        with open(self.path(chat_id), "r", encoding="UTF8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a write torn by a crash, the file is compacted on the next save
+                    logging.warning(f'A damaged history record was skipped (id: {chat_id})')
+                    clean = False
+                    continue
+                if 'role' in record:
+                    if not head or (record.get('summary') and not tail):
+                        head.append(record)
+                    else:
+                        tail.append(record)
+                elif 'drop' in record:
+                    for _ in range(min(record['drop'], len(tail))):
+                        tail.popleft()
+                    obsolete += record['drop'] + 1
+                elif 'meta' in record:
+                    obsolete += 1 if meta else 0
+                    meta = record['meta']
+
+        history = head + list(tail)
+        if clean:
+            self.__remember(chat_id, meta, history, obsolete)
+        data = dict(meta, history=history)
+        if all('tokens' in message for message in history):
+            data['tokens'] = sum(message['tokens'] for message in history)
+        return data
+
+    def save(self, chat_id: str, data: dict):
+        """
+        Appending the changes of the history to the log, compacting it when they are not appends and evictions
+        :param chat_id: Telegram chat id
+        :param data: Data with chat history
+        """
+        meta = {key: value for key, value in data.items() if key not in ('history', 'tokens')}
+        history = data['history']
+        with self._lock:
+            written = self._written.get(chat_id)
+        records = self.__diff(written, meta, history) if written is not None else None
+        if records is not None:
+            # a new metadata record replaces the previous one, a drop record removes itself and the messages
+            obsolete = written[2] + sum(record.get('drop', 0) + 1 for record in records if 'role' not in record)
+        if records is None or obsolete > max(len(history), 32):
+            self.__compact(chat_id, meta, history)
+            obsolete = 0
+        elif records:
+            with open(self.path(chat_id), "a", encoding="UTF8") as file:
+                file.write(''.join(self.record(record) for record in records))
+                self.__sync(file, 'always')
+        self.__remember(chat_id, meta, history, obsolete)
+
+    def __diff(self, written: tuple, meta: dict, history: list):
+        """
+        Records turning the written history into the new one
+        :return: list of records or None when the change is not an append or an eviction
+        """
+        old_meta, old_history, _ = written
+        head = self.head_size(old_history)
+        if self.head_size(history) != head or history[:head] != old_history[:head]:
+            return None
+        old_tail, tail = old_history[head:], history[head:]
+        for dropped in range(len(old_tail) + 1):
+            kept = len(old_tail) - dropped
+            if old_tail[dropped:] == tail[:kept]:
+                break
+        else:
+            return None
+        records = [{'meta': meta}] if meta != old_meta else []
+        if dropped:
+            records.append({'drop': dropped})
+        return records + tail[kept:]
+
+    def __compact(self, chat_id: str, meta: dict, history: list):
+        path = self.path(chat_id)
+        with open(path + '.tmp', "w", encoding="UTF8") as file:
+            file.write(self.record({'meta': meta}) + ''.join(self.record(message) for message in history))
+            self.__sync(file, 'always', 'compaction')
+        os.replace(path + '.tmp', path)
+        if self.fsync != 'never' and os.name == 'posix':
+            folder = os.open(self.folder, os.O_RDONLY)
+            try:
+                os.fsync(folder)
+            finally:
+                os.close(folder)
+
+    def __sync(self, file, *policies):
+        if self.fsync in policies:
+            file.flush()
+            os.fsync(file.fileno())
+
+    def __remember(self, chat_id: str, meta: dict, history: list, obsolete: int):
+        with self._lock:
+            self._written[chat_id] = (meta, list(history), obsolete)
+            self._written.move_to_end(chat_id)
+            while len(self._written) > self.cache_size:
+                self._written.popitem(last=False)
+
+    def __migrate(self, chat_id: str):
+        data = self.legacy.load(chat_id)
+        self.save(chat_id, data)
+        os.remove(self.legacy.path(chat_id))
+        logging.info(f'The history file was migrated to the log format (id: {chat_id})')
+        return data
+
+    def lock(self, chat_id: str):
+        return NoLock()
+
+    def chat_ids(self):
+        return sorted({name.rsplit('.', 1)[0] for name in os.listdir(self.folder)
+                       if name.endswith('.jsonl') or name.endswith('.json')})
+
+
+class SqliteBackend:
+    shared = True
+
+    def __init__(self, path: str, lock_folder: str = 'history/locks'):
+        """
+        Histories in a SQLite database in WAL mode shared by the processes of one host
+        :param path: path to the database file
+        :param lock_folder: folder of the per-chat lock files
+        """
+        if fcntl is None:
+            raise RuntimeError('The sqlite history backend needs fcntl file locks, which are not available here')
+        self.path = path
+        self.lock_folder = lock_folder
+        os.makedirs(lock_folder, exist_ok=True)
+        self._local = threading.local()
+        self.__connection().execute('CREATE TABLE IF NOT EXISTS history (chat_id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+
+    def __connection(self):
+        """
+        Connection of the current thread, sqlite connections are not shared between threads
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def exists(self, chat_id: str):
+        row = self.__connection().execute('SELECT 1 FROM history WHERE chat_id = ?', (chat_id,)).fetchone()
+        return row is not None
+
+    def load(self, chat_id: str):
+        row = self.__connection().execute('SELECT data FROM history WHERE chat_id = ?', (chat_id,)).fetchone()
+        if row is None:
+            raise KeyError(chat_id)
+        return json.loads(row[0])
+
+    def save(self, chat_id: str, data: dict):
+        self.__connection().execute('INSERT OR REPLACE INTO history (chat_id, data) VALUES (?, ?)',
+                                    (chat_id, json.dumps(data, ensure_ascii=False)))
+
+    def lock(self, chat_id: str):
+        return FileLock(f'{self.lock_folder}/{chat_id}.lock')
+
+    def chat_ids(self):
+        return [row[0] for row in self.__connection().execute('SELECT chat_id FROM history')]
+
+
+class RedisBackend:
+    shared = True
+
+    def __init__(self, url: str, lock_timeout: float, client=None):
+        """
+        Histories in Redis shared by the bot workers of all hosts
+        :param url: Redis connection URL
+        :param lock_timeout: seconds after which the lock of a crashed worker expires
+        :param client: Redis-compatible client, e.g. a local stand-in for tests
+        """
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError('The redis history backend needs the redis package: pip install redis')
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.lock_timeout = lock_timeout
+
+    def exists(self, chat_id: str):
+        return bool(self.client.exists(f'history:{chat_id}'))
+
+    def load(self, chat_id: str):
+        data = self.client.get(f'history:{chat_id}')
+        if data is None:
+            raise KeyError(chat_id)
+        return json.loads(data)
+
+    def save(self, chat_id: str, data: dict):
+        self.client.set(f'history:{chat_id}', json.dumps(data, ensure_ascii=False))
+
+    def lock(self, chat_id: str):
+        # the lock is acquired and released by different threads of the I/O pool
+        return self.client.lock(f'lock:{chat_id}', timeout=self.lock_timeout, thread_local=False)
+
+    def chat_ids(self):
+        return [key.decode()[len('history:'):] for key in self.client.scan_iter('history:*')]
+
+
+def create_backend(config: dict):
+    """
+    Creating the history backend selected in the configuration
+    :param config: dictionary with history store configurations
+    """
+    if config['backend'] == 'json':
+        return JsonFileBackend()
+    if config['backend'] == 'jsonl':
+        return JsonLinesBackend(fsync=config['fsync'], cache_size=config['cache_size'])
+    if config['backend'] == 'sqlite':
+        return SqliteBackend(config['sqlite_path'])
+    if config['backend'] == 'redis':
+        return RedisBackend(config['redis_url'], config['lock_timeout'])
+    raise ValueError(f"Unknown history backend {config['backend']}, use jsonl, json, sqlite or redis")
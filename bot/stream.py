@@ -0,0 +1,47 @@
+from typing import NamedTuple, Optional
+
+CHUNK_PARTS = 256
+
+
+class StreamEvent(NamedTuple):
+    """
+    Event of a streamed answer: a text delta, or the finish reason, usage and the whole answer in the last event
+    """
+    delta: str = ''
+    finish_reason: Optional[str] = None
+    usage: Optional[dict] = None
+    text: Optional[str] = None
+
+
+class TextBuffer:
+
+    def __init__(self):
+        """
+        Text built from stream deltas without copying the whole text on every delta, the deltas
+        are joined into chunks to keep the memory close to the size of the text
+        """
+        self._chunks = []
+        self._parts = []
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, delta: str):
+        self._parts.append(delta)
+        self._size += len(delta)
+        if len(self._parts) >= CHUNK_PARTS:
+            self._chunks.append(''.join(self._parts))
+            self._parts = []
+
+    @property
+    def text(self) -> str:
+        if self._parts or len(self._chunks) > 1:
+            self._chunks = [''.join(self._chunks + self._parts)]
+            self._parts = []
+        return self._chunks[0] if self._chunks else ''
+
+    def clear(self):
+        self._chunks = []
+        self._parts = []
+        self._size = 0
@@ -1,32 +1,58 @@
 import asyncio
+import io
 import logging
-import os
+import signal
+from urllib.parse import urlparse
 
 from aiogram import Bot
 from aiogram import types
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import Dispatcher
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ContentType, BotCommand
 from aiogram.utils import executor
-from aiogram.utils.exceptions import RetryAfter, CantParseEntities, TelegramAPIError
+from aiogram.utils.exceptions import CantParseEntities, TelegramAPIError
+from aiohttp import web
 
+from chat_queue import ChatQueue
+import metrics
 from chatai import GPT
-from voicing import Announcer
+from render import RenderScheduler
+from scheduler import QueueOverloaded
+from segmenter import Segmenter, split_text
+from users import UserRegistry
+from speech import SpeechQueueFull, SpeechService
 from openai.error import RateLimitError
 
 
+class TraceMiddleware(BaseMiddleware):
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        """
+        Every update gets its own trace id in the log records of its handlers
+        """
+        trace = metrics.new_trace()
+        logging.debug(f'Update {update.update_id} is traced as {trace}')
+
+
 class TelegramBot:
 
-    def __init__(self, config: dict, gpt, announcer):
+    def __init__(self, config: dict, gpt, speech):
         """
-        Bot initialization with the given configuration, gpt object and announcer object
+        Bot initialization with the given configuration, gpt object and speech service
         :param config: dictionary with bot configurations
         :param gpt: GPT object
-        :param announcer: Announcer object
+        :param speech: SpeechService object
         """
-        self.storage = MemoryStorage()
-        self.bot = Bot(token=config["token_bot"])
-        self.allowed_user_ids = config['allowed_user_ids']
+        if config['redis_url']:
+            from aiogram.contrib.fsm_storage.redis import RedisStorage2
+            self.storage = RedisStorage2(**self.__redis_params(config['redis_url']))
+        else:
+            self.storage = MemoryStorage()
+        server = TelegramAPIServer.from_base(config['telegram_api']) if config['telegram_api'] else TELEGRAM_PRODUCTION
+        self.bot = Bot(token=config["token_bot"], server=server)
+        self.users = UserRegistry(config)
         self.bot_command = [
             BotCommand('clear', 'Cleaning up the conversation '),
             BotCommand('system_role',
@@ -35,18 +61,57 @@ class TelegramBot:
             BotCommand('help', "I'll show you how to use this bot"),
         ]
         self.dp = Dispatcher(self.bot, storage=self.storage)
+        self.dp.middleware.setup(TraceMiddleware())
         self.in_cor = InlineKeyboardMarkup(row_width=4)
         self.button_clear = InlineKeyboardButton(text="voice", callback_data="voice")
         self.in_cor.add(self.button_clear)
         self.gpt: GPT = gpt
-        self.announcer: Announcer = announcer
+        self.speech: SpeechService = speech
         self.config = config
+        self.chats = ChatQueue(config)
+        self.render = RenderScheduler(config)
+        self._active = set()
+        self._metrics = None
+
+    @staticmethod
+    def __redis_params(url: str):
+        url = urlparse(url)
+        return {'host': url.hostname or 'localhost', 'port': url.port or 6379,
+                'db': int(url.path.lstrip('/') or 0), 'password': url.password}
 
     async def _on_startup(self, dp: Dispatcher):
         """
         Run when the bot starts, sends a set of commands
         """
         await dp.bot.set_my_commands(self.bot_command)
+        if self.config['webhook_url']:
+            await dp.bot.set_webhook(self.config['webhook_url'] + self.config['webhook_path'],
+                                     secret_token=self.config['webhook_secret'])
+        if self.config['metrics_port']:
+            self._metrics = await metrics.serve(self.config['metrics_host'], self.config['metrics_port'])
+        await self.gpt.client.start()
+        self.gpt.history.start()
+        self.gpt.offload.start()
+        await self.speech.start()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.users.reload)
+        except (AttributeError, NotImplementedError):
+            logging.info('Reloading the allowed users by SIGHUP is not supported on this platform')
+
+    async def _on_shutdown(self, dp: Dispatcher):
+        """
+        Run when the bot stops, lets the replies in progress finish,
+        writes the cached chat histories and closes the sessions
+        """
+        if self._active:
+            logging.info(f'Waiting for {len(self._active)} replies in progress')
+            await asyncio.wait(self._active, timeout=self.config['drain_timeout'])
+        await self.gpt.history.close()
+        await self.gpt.client.close()
+        self.gpt.offload.shutdown()
+        await self.speech.shutdown()
+        if self._metrics is not None:
+            await self._metrics.cleanup()
 
     async def _help(self, message: types.Message):
         """
@@ -72,55 +137,59 @@ class TelegramBot:
         Sending a model response by user message
         """
         text = message.text if not audio else text
+        task = asyncio.current_task()
+        self._active.add(task)
         try:
-            if self.config['stream']:
-                await self.bot.send_chat_action(message.from_user.id, "typing")
-                counter = 0
-                is_new_message_sent = 0
-                content = await message.reply("...")
-                stream_response = self.gpt.create_chat_stream(text, chat_id=str(message.from_user.id))
-                async for response, tag in stream_response:
-                    chunks = self.__text_into_chunks(response)  # splits the text into chunks
-                    if len(chunks) == 0:
-                        continue
-                    chunk = chunks[-1]
-                    if len(chunks) > 1 and is_new_message_sent == 0:
+            await self.__reply(message, text)
+        finally:
+            self._active.discard(task)
+
+    async def __reply(self, message: types.Message, text: str):
+        """
+        Sending the model response, one request per chat at a time
+        """
+        async with self.chats.turn(str(message.from_user.id), text) as text:
+            if text is None:
+                logging.info(f"Message merged into the pending request (id: {message.from_user.id})")
+                return
+            try:
+                if self.config['stream']:
+                    await self.bot.send_chat_action(message.from_user.id, "typing")
+                    chat_id = message.from_user.id
+                    content = await message.reply("...")
+                    renderer = self.render.stream(chat_id, content)
+                    segmenter = Segmenter(4096)
+                    stream_response = self.gpt.create_chat_stream(text, chat_id=str(message.from_user.id))
+                    async for event in stream_response:
+                        for segment in segmenter.feed(event.delta):
+                            await renderer.finish(segment, reply_markup=self.in_cor)
+                            await self.render.acquire(chat_id)
+                            content = await message.reply("...")
+                            renderer = self.render.stream(chat_id, content)
+                        if event.finish_reason is None:
+                            # the text of the message is only built when an edit is due
+                            if renderer.due(len(segmenter)):
+                                await renderer.update(segmenter.tail)
+                            continue
+                        chunks = segmenter.close()
+                        if chunks:
+                            await renderer.finish(chunks[0], reply_markup=self.in_cor)
+                        else:
+                            await content.delete()
+                else:
+                    await self.bot.send_message(message.from_user.id,
+                                                f"Sending a request to the {self.gpt.config['model']} model")
+                    answer = await self.gpt.create_chat(text, message.from_user.id)
+                    chunks = split_text(answer, 4096)
+
+                    for chunk in chunks:
                         try:
-                            await content.edit_text(chunks[0], reply_markup=self.in_cor,
-                                                    parse_mode=types.ParseMode.MARKDOWN)
-                        except CantParseEntities:
-                            await content.edit_text(chunks[0], reply_markup=self.in_cor)
-                        content = await message.reply("...")
-                        is_new_message_sent += 1
-                        counter = 0
-                    try:
-                        if not tag and counter % 60 == 0:
-                            await content.edit_text(chunk)
-                        elif tag:
-                            await content.edit_text(chunk, reply_markup=self.in_cor,
-                                                    parse_mode=types.ParseMode.MARKDOWN)
-
-                    except RetryAfter as e:
-                        logging.warning(e)
-                        await asyncio.sleep(e.timeout)
-                    except CantParseEntities:
-                        await content.edit_text(chunk, reply_markup=self.in_cor)
-                    counter += 1
-                    await asyncio.sleep(0.01)
-            else:
-                await self.bot.send_message(message.from_user.id,
-                                            f"Sending a request to the {self.gpt.config['model']} model")
-                answer = await self.gpt.create_chat(text, message.from_user.id)
-                chunks = self.__text_into_chunks(answer)
-
-                for chunk in chunks:
-                    try:
-                        await message.reply(chunk, reply_markup=self.in_cor, parse_mode=types.ParseMode.MARKDOWN)
-                    except CantParseEntities as e:
-                        await message.reply(chunk, reply_markup=self.in_cor)
-        except RateLimitError as e:
-            logging.error(f'Errors when sending opeanai request: {e}')
-            await self.bot.send_message(message.from_user.id, f"Error when requesting: {e}")
+                            await message.reply(chunk, reply_markup=self.in_cor, parse_mode=types.ParseMode.MARKDOWN)
+                        except CantParseEntities as e:
+                            await message.reply(chunk, reply_markup=self.in_cor)
+            except (RateLimitError, QueueOverloaded) as e:
+                logging.error(f'Errors when sending opeanai request: {e}')
+                await self.bot.send_message(message.from_user.id, f"Error when requesting: {e}")
 
     async def error_handler(self, update: types.Update, exception):
         """
@@ -141,22 +210,21 @@ class TelegramBot:
             return
 
         await self.bot.send_chat_action(message.from_user.id, "upload_photo")
-        url_image = await self.gpt.generate_image(prompt)
+        url_image = await self.gpt.generate_image(prompt, chat_id=str(message.from_user.id))
         if not url_image.startswith("https://"):
             await message.reply(url_image)
             return
         await self.bot.send_photo(message.from_user.id, url_image)
 
     async def _allowed_users_filter(self, message: types.Message):
-        if self.allowed_user_ids == '*':
-            self.gpt.create_user_history(f'{message.from_user.id}', f'@{message.from_user.username}')
-            return True
+        user_id = message.from_user.id
+        if not self.users.allowed(user_id):
+            return False
 
-        if str(message.from_user.id) in self.allowed_user_ids.split(','):
-            self.gpt.create_user_history(f'{message.from_user.id}', f'@{message.from_user.username}')
-            return True
-
-        return False
+        if user_id not in self.users.initialised:
+            await self.gpt.create_user_history(f'{user_id}', f'@{message.from_user.username}')
+            self.users.initialised.add(user_id)
+        return True
 
     async def _voicing(self, callback: types.CallbackQuery):
         """
@@ -164,27 +232,38 @@ class TelegramBot:
         """
         logging.info(
             f'Request to be converted into audio from {callback.from_user.username} (id: {callback.from_user.id})')
+        if not self.speech.ready:
+            self.speech.warm_up()
+            await self.bot.send_message(callback.from_user.id, "The voice is warming up, try again in a minute")
+            return
+        announcer = self.speech.announcer
         await self.bot.send_chat_action(callback.from_user.id, 'record_voice')
-        voices = await self.announcer.voicing(callback.message.text, callback.from_user.id)
-        for voice in voices:
-            if voice is None:
-                await self.bot.send_message(callback.from_user.id, "Unfortunately, I can't recognize this message")
-                return
-            await self.bot.send_chat_action(callback.from_user.id, 'upload_voice')
-            ogg_file = types.InputFile(voice)
-            try:
-                await self.bot.send_voice(callback.from_user.id, ogg_file)
-            except TelegramAPIError as e:
-                logging.warning(e)
-            finally:
-                os.remove(voice)
+        sent = 0
+        try:
+            async for key, voice in announcer.voicing(callback.message.text):
+                await self.bot.send_chat_action(callback.from_user.id, 'upload_voice')
+                if not isinstance(voice, str):
+                    voice = types.InputFile(voice, filename=f'voice_{sent}.ogg')
+                try:
+                    voice_message = await self.bot.send_voice(callback.from_user.id, voice)
+                    announcer.cache.remember(key, voice_message.voice.file_id)
+                except TelegramAPIError as e:
+                    logging.warning(e)
+                    announcer.cache.forget(key)
+                sent += 1
+        except SpeechQueueFull as e:
+            logging.warning(f'{e}, stats: {announcer.workers.stats()}')
+            await self.bot.send_message(callback.from_user.id, "I'm busy voicing other messages, try again later")
+            return
+        if sent == 0:
+            await self.bot.send_message(callback.from_user.id, "Unfortunately, I can't recognize this message")
 
     async def _clear_chat(self, message: types.Message):
         """
         Clear command processing
         """
         logging.info(f"Clear history from @{message.from_user.username} (id: {message.from_user.id})")
-        self.gpt.clear_history(chat_id=str(message.from_user.id))
+        await self.gpt.clear_history(chat_id=str(message.from_user.id))
         await self.bot.send_message(message.from_user.id, "History brushed off✅")
 
     async def _get_system_message_for_user(self, message: types.Message):
@@ -192,7 +271,7 @@ class TelegramBot:
         Processing the system_role command
         """
         text = message.text.replace("/system_message", "")
-        self.gpt.system_message(text, chat_id=str(message.from_user.id))
+        await self.gpt.system_message(text, chat_id=str(message.from_user.id))
         await self.bot.send_message(message.from_user.id, "Complete✅")
 
     async def _audio_to_chat(self, audio: types.Message):
@@ -200,11 +279,16 @@ class TelegramBot:
         Voice message processing
         """
         logging.info(f"New audio received from user @{audio.from_user.username} (id: {audio.from_user.id})")
-        await audio.voice.download(destination_file=f'audio/{audio.from_user.id}.ogg')
-        await self.gpt.convert_audio(chat_id=str(audio.from_user.id))
-        text = await self.gpt.transcriptions(chat_id=str(audio.from_user.id))
+        voice = io.BytesIO()
+        voice.name = 'voice.ogg'  # Whisper detects the format by the file name
+        await audio.voice.download(destination_file=voice)
+        try:
+            text = await self.gpt.transcriptions(voice, chat_id=str(audio.from_user.id))
+        except (RateLimitError, QueueOverloaded) as e:
+            logging.error(f'Errors when sending opeanai request: {e}')
+            await self.bot.send_message(audio.from_user.id, f"Error when requesting: {e}")
+            return
         await self._chat(audio, text, audio=True)
-        await self.gpt.delete_audio(chat_id=audio.from_user.id)
 
     async def _message(self, message: types.Message):
         """
@@ -213,9 +297,6 @@ class TelegramBot:
         logging.info(f"New message received from user @{message.from_user.username} (id: {message.from_user.id})")
         await self._chat(message)
 
-    def __text_into_chunks(self, text: str, split_size: int = 4096) -> list[str]:
-        return [text[i:i + split_size] for i in range(0, len(text), split_size)]
-
     def _reg_handler(self, dp: Dispatcher):
         """
         registration of message handlers
@@ -231,9 +312,29 @@ class TelegramBot:
         dp.register_message_handler(self._message, self._allowed_users_filter)
         dp.register_errors_handler(self.error_handler)
 
+    @web.middleware
+    async def _check_secret(self, request: web.Request, handler):
+        """
+        Rejecting the webhook requests that do not come from Telegram
+        """
+        secret = self.config['webhook_secret']
+        if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            logging.warning(f'Webhook request with a wrong secret token from {request.remote}')
+            raise web.HTTPForbidden()
+        return await handler(request)
+
     def run(self):
         """
         bot startup
         """
         self._reg_handler(self.dp)
-        executor.start_polling(self.dp, skip_updates=True, on_startup=self._on_startup)
+        if not self.config['webhook_url']:
+            executor.start_polling(self.dp, skip_updates=True, on_startup=self._on_startup,
+                                   on_shutdown=self._on_shutdown)
+            return
+
+        # the updates queued while the bot was down are processed, other workers may be serving them
+        runner = executor.set_webhook(self.dp, webhook_path=self.config['webhook_path'],
+                                      on_startup=self._on_startup, on_shutdown=self._on_shutdown,
+                                      web_app=web.Application(middlewares=[self._check_secret]))
+        runner.run_app(host=self.config['webhook_host'], port=self.config['webhook_port'])
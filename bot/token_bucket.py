@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        Token bucket rate limiter
+        :param rate: tokens added per second
+        :param capacity: maximum number of tokens, the rate by default
+        """
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self, amount: float = 1) -> bool:
+        self.__refill()
+        return self.tokens >= amount
+
+    def full(self) -> bool:
+        self.__refill()
+        return self.tokens >= self.capacity
+
+    def try_acquire(self, amount: float = 1) -> bool:
+        """
+        Taking tokens without waiting
+        :return: True if the tokens were taken
+        """
+        if not self.ready(amount):
+            return False
+        self.tokens -= amount
+        return True
+
+    async def acquire(self, amount: float = 1):
+        """
+        Waiting until the tokens are available and taking them
+        """
+        while not self.try_acquire(amount):
+            await asyncio.sleep(max(0.01, (amount - self.tokens) / self.rate))
+
+    def delay(self, amount: float = 1) -> float:
+        """
+        Seconds until the tokens are available
+        """
+        self.__refill()
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def block(self, seconds: float):
+        """
+        Emptying the bucket for the given time, e.g. after a flood wait from the server
+        """
+        self.__refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
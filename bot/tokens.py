@@ -0,0 +1,122 @@
+from functools import lru_cache
+
+import tiktoken
+
+from offload import Offloader
+
+MESSAGE_KEYS = ("role", "content", "name")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """
+    Resolves the tokenizer once per model
+    :param model: OpenAI model name
+    :return: tiktoken encoding
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(model: str, text: str) -> int:
+    """
+    Number of tokens in the text, runs in the worker processes for long texts
+    """
+    return len(get_encoding(model).encode(text))
+
+
+class TokenCounter:
+
+    def __init__(self, model: str, offload: Offloader = None):
+        """
+        Token accounting of the chat history
+        :param model: OpenAI model name
+        :param offload: executor for tokenizing long texts outside the event loop
+        """
+        self.model = model
+        self.encoding = get_encoding(model)
+        self.offload = offload
+
+    def count_message(self, message: dict) -> int:
+        """
+        Returns the number of tokens used by a single message
+        :param message: message with role and content
+        :return: number of tokens
+        """
+        num_tokens = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+        for key, value in message.items():
+            if key not in MESSAGE_KEYS:
+                continue
+            num_tokens += len(self.encoding.encode(value))
+            if key == "name":  # if there's a name, the role is omitted
+                num_tokens += -1  # role is always required and always 1 token
+        return num_tokens
+
+    async def measure(self, message: dict) -> int:
+        """
+        Returns the number of tokens used by a single message, long texts are tokenized in a worker process
+        :param message: message with role and content
+        :return: number of tokens
+        """
+        content = message.get("content", "")
+        if self.offload is None or len(content) < self.offload.cpu_threshold:
+            return self.count_message(message)
+        short = {key: value for key, value in message.items() if key != "content"}
+        return self.count_message(short) + await self.offload.run_cpu(count_tokens, self.model, content)
+
+    def count_messages(self, messages: list) -> int:
+        """
+        Returns the number of tokens used by a list of messages, reusing the stored counts
+        :param messages: list of messages
+        :return: number of tokens
+        """
+        num_tokens = sum(message.get("tokens") or self.count_message(message) for message in messages)
+        return num_tokens + 2  # every reply is primed with <im_start>assistant
+
+    async def annotate(self, data: dict) -> int:
+        """
+        Storing the token count next to every message and the running total in the chat data
+        :param data: Data with chat history
+        :return: total number of tokens in the history
+        """
+        total = 0
+        for message in data['history']:
+            if 'tokens' not in message:
+                message['tokens'] = await self.measure(message)
+            total += message['tokens']
+        data['tokens'] = total
+        return total
+
+    async def append(self, data: dict, role: str, content: str):
+        """
+        Adding a message to the history and updating the running total
+        :param data: Data with chat history
+        :param role: message author role
+        :param content: message text
+        """
+        if 'tokens' not in data:
+            await self.annotate(data)
+        message = {"role": role, "content": content}
+        message['tokens'] = await self.measure(message)
+        data['history'].append(message)
+        data['tokens'] += message['tokens']
+
+    def evict(self, data: dict, index: int):
+        """
+        Removing a message from the annotated history and updating the running total
+        :param data: Data with chat history
+        :param index: position of the message in the history
+        :return: the removed message
+        """
+        message = data['history'].pop(index)
+        data['tokens'] -= message['tokens']
+        return message
+
+    @staticmethod
+    def strip(messages: list) -> list:
+        """
+        Removing the token counts and other bookkeeping before sending the messages to the API
+        """
+        return [{key: value for key, value in message.items() if key in MESSAGE_KEYS} for message in messages]
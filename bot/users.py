@@ -0,0 +1,52 @@
+import logging
+import os
+
+from dotenv import load_dotenv
+
+
+class UserRegistry:
+
+    def __init__(self, config: dict):
+        """
+        Allow-list and the users whose history is initialised
+        :param config: dictionary with bot configurations
+        """
+        self.allowed_users_file = config['allowed_users_file']
+        self.allowed_user_ids = self.parse(config['allowed_user_ids'])
+        self.initialised = set()
+        if self.allowed_users_file:
+            self.reload()
+
+    @staticmethod
+    def parse(value: str):
+        """
+        Parsing the allow-list
+        :param value: comma or newline separated Telegram user ids or *
+        :return: frozenset of user ids or None when everyone is allowed
+        """
+        ids = value.replace('\n', ',').split(',')
+        ids = [user_id.strip() for user_id in ids if user_id.strip()]
+        if '*' in ids:
+            return None
+        return frozenset(int(user_id) for user_id in ids)
+
+    def allowed(self, user_id: int) -> bool:
+        return self.allowed_user_ids is None or user_id in self.allowed_user_ids
+
+    def reload(self):
+        """
+        Reading the allow-list again from the file or the .env file without restarting the bot
+        """
+        try:
+            if self.allowed_users_file:
+                with open(self.allowed_users_file, "r", encoding="UTF8") as file:
+                    value = file.read()
+            else:
+                load_dotenv(override=True)
+                value = os.environ.get('ALLOWED_TELEGRAM_USER_IDS', '*')
+            self.allowed_user_ids = self.parse(value)
+        except (OSError, ValueError) as e:
+            logging.error(f'Failed to reload the allowed users, the previous list is kept: {e}')
+            return
+        count = 'all' if self.allowed_user_ids is None else len(self.allowed_user_ids)
+        logging.info(f'The allowed users were reloaded ({count})')
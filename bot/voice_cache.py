@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+
+class VoiceCache:
+
+    def __init__(self, config: dict, folder: str = 'voice'):
+        """
+        Cache of synthesised voices with memory and disk tiers and Telegram file ids
+        :param config: dictionary with voicing configurations
+        :param folder: folder of the disk tier
+        """
+        self.folder = folder
+        self.memory_limit = config['voice_cache_memory']
+        self.disk_limit = config['voice_cache_disk']
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk = OrderedDict()
+        self._disk_size = 0
+        self._file_ids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.__scan()
+
+    @staticmethod
+    def key(text: str, language: str, speaker: str, sample_rate: int, model_file: str):
+        """
+        Content address of a voice
+        :return: hex digest of the synthesis parameters
+        """
+        content = '\0'.join((text, language, speaker, str(sample_rate), os.path.basename(model_file)))
+        return hashlib.sha256(content.encode('UTF8')).hexdigest()
+
+    def __contains__(self, key: str):
+        return key in self._file_ids or key in self._memory or key in self._disk
+
+    async def get(self, key: str):
+        """
+        Getting the cached voice
+        :param key: content address of the voice
+        :return: Telegram file id, bytes of the OGG/Opus voice or None
+        """
+        if key in self._file_ids:
+            self._file_ids.move_to_end(key)
+            self.hits += 1
+            return self._file_ids[key]
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return self._memory[key]
+        if key in self._disk:
+            self._disk.move_to_end(key)
+            try:
+                data = await asyncio.to_thread(self.__read, key)
+            except OSError as e:
+                logging.warning(f'Cached voice {key} is unreadable: {e}')
+                self._disk_size -= self._disk.pop(key)
+            else:
+                self.hits += 1
+                self.__put_memory(key, data)
+                return data
+        self.misses += 1
+
+    async def put(self, key: str, data: bytes):
+        """
+        Saving the synthesised voice to both tiers
+        :param key: content address of the voice
+        :param data: bytes of the OGG/Opus voice
+        """
+        self.__put_memory(key, data)
+        if self.disk_limit <= 0 or key in self._disk:
+            return
+        self._disk[key] = len(data)
+        self._disk_size += len(data)
+        evicted = []
+        while self._disk_size > self.disk_limit and len(self._disk) > 1:
+            old_key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            evicted.append(old_key)
+        try:
+            await asyncio.to_thread(self.__write, key, data, evicted)
+        except OSError as e:
+            logging.warning(f'Failed to cache voice {key}: {e}')
+            self._disk_size -= self._disk.pop(key, 0)
+
+    def remember(self, key: str, file_id: str):
+        """
+        Saving the Telegram file id of the uploaded voice so repeats need no upload
+        :param key: content address of the voice
+        :param file_id: Telegram file id
+        """
+        self._file_ids[key] = file_id
+        self._file_ids.move_to_end(key)
+        while len(self._file_ids) > 10000:
+            self._file_ids.popitem(last=False)
+
+    def forget(self, key: str):
+        """
+        Dropping a file id that Telegram no longer accepts
+        """
+        self._file_ids.pop(key, None)
+
+    def __put_memory(self, key: str, data: bytes):
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_limit and self._memory:
+            self._memory_size -= len(self._memory.popitem(last=False)[1])
+
+    def __path(self, key: str):
+        return f'{self.folder}/{key}.ogg'
+
+    def __read(self, key: str):
+        with open(self.__path(key), 'rb') as file:
+            return file.read()
+
+    def __write(self, key: str, data: bytes, evicted: list):
+        with open(self.__path(key), 'wb') as file:
+            file.write(data)
+        for old_key in evicted:
+            try:
+                os.remove(self.__path(old_key))
+            except FileNotFoundError:
+                pass
+
+    def __scan(self):
+        """
+        Indexing the disk tier left from the previous run, oldest first
+        """
+        if not os.path.isdir(self.folder):
+            return
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith('.ogg'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_size += size
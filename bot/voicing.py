@@ -1,79 +1,352 @@
 import asyncio
+import io
 import logging
 import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
+import soundfile as sf
 import torch
-from langdetect import detect
+from langdetect import DetectorFactory, detect
+from langdetect.lang_detect_exception import LangDetectException
 from transliterate import translit
 
+from metrics import TTS_INFERENCE, TTS_MODEL_LOAD
+from segmenter import split_text
+from speech import SpeechQueueFull
+from voice_cache import VoiceCache
+
+DetectorFactory.seed = 0  # makes langdetect deterministic
+SWITCH_MIN_LETTERS = 60  # shorter paragraphs in another language are voiced with the surrounding text
+SCRIPT_SHARE = 0.8
+
+
+@lru_cache(maxsize=4096)
+def detect_language(text: str):
+    """
+    Detecting the language of the text, repeated texts are answered from the cache
+    :param text: text to detect
+    :return: language code or None
+    """
+    try:
+        return detect(text)
+    except LangDetectException:
+        return None
+
+
+def script_language(text: str, share: float = SCRIPT_SHARE):
+    """
+    Telling Russian from English by the alphabet, list items, code and names mixed into a line do not confuse it
+    :param text: text to check
+    :param share: part of the letters that must be in one alphabet
+    :return: 'ru' or 'en' when one alphabet has most of the letters, otherwise None, and the number of letters
+    """
+    cyrillic = sum('\u0400' <= char <= '\u04ff' for char in text)
+    latin = sum(char.isascii() and char.isalpha() for char in text)
+    letters = cyrillic + latin
+    if letters and cyrillic >= share * letters:
+        return 'ru', letters
+    if letters and latin >= share * letters:
+        return 'en', letters
+    return None, letters
+
+
+def split_languages(message: str, languages) -> list:
+    """
+    Splitting the message into runs of paragraphs in one language. The language of the whole message is the default,
+    only a long paragraph clearly written in another alphabet starts a run in another language, a paragraph in
+    the default language ends it
+    :param message: Message from the model
+    :param languages: languages that can be voiced
+    :return: list of (language, text), empty when the message has no language to voice
+    """
+    default = detect_language(message) if message.strip() else None
+    if default not in languages:
+        # langdetect may answer a close language, e.g. uk or bg for a Russian text
+        default, _ = script_language(message, share=0.5)
+    if default not in languages:
+        return []
+
+    runs = [[default, []]]
+    for paragraph in message.split('\n'):
+        language, letters = script_language(paragraph)
+        if language not in languages or letters < SWITCH_MIN_LETTERS and language != default:
+            # short lines, code and numbers are voiced by the model of the surrounding text
+            language = runs[-1][0]
+        if language != runs[-1][0]:
+            runs.append([language, []])
+        runs[-1][1].append(paragraph)
+    return [(language, '\n'.join(paragraphs)) for language, paragraphs in runs if ''.join(paragraphs).strip()]
+
+
+class ModelRegistry:
+
+    def __init__(self, device):
+        """
+        Keeping the loaded speech models in memory
+        :param device: torch device for the models
+        """
+        self.device = device
+        self._models = {}
+        self._locks = {}
+
+    async def get(self, local_file: str):
+        """
+        Getting the model, loading it on first use
+        :param local_file: path to the file with the model
+        :return: the model ready for inference
+        """
+        if local_file in self._models:
+            return self._models[local_file]
+        async with self._locks.setdefault(local_file, asyncio.Lock()):
+            if local_file not in self._models:
+                self._models[local_file] = await asyncio.to_thread(self.__load, local_file)
+        return self._models[local_file]
+
+    def __load(self, local_file: str):
+        with TTS_MODEL_LOAD.time(model=local_file):
+            model = torch.package.PackageImporter(local_file).load_pickle('tts_models', 'model')
+            model.to(self.device)
+        logging.info(f"Model {local_file} is loaded")
+        return model
+
+
+class SpeechWorkers:
+
+    def __init__(self, config: dict):
+        """
+        Thread pool running the speech synthesis with a bounded job queue
+        :param config: dictionary with voicing configurations
+        """
+        self.threads = config['tts_threads']
+        self.workers = config['tts_workers'] or max(1, (os.cpu_count() or 1) // self.threads)
+        self.queue_size = config['tts_queue_size']
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='tts',
+                                            initializer=torch.set_num_threads, initargs=(self.threads,))
+        self.depth = 0
+        self.completed = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+
+    def submit(self, func, *args_list):
+        """
+        Queueing one synthesis job per argument tuple
+        :param func: blocking function to run
+        :param args_list: argument tuples, one per job
+        :return: list of futures with the job results
+        :raises SpeechQueueFull: when the jobs do not fit into the queue
+        """
+        if self.depth + len(args_list) > self.workers + self.queue_size:
+            raise SpeechQueueFull(f'{self.depth} speech jobs are already queued')
+        loop = asyncio.get_running_loop()
+        futures = []
+        for args in args_list:
+            self.depth += 1
+            future = loop.run_in_executor(self._executor, self.__job, func, args, time.perf_counter())
+            future.add_done_callback(self.__done)
+            futures.append(future)
+        return futures
+
+    def free(self) -> int:
+        """
+        Number of jobs that can be queued without overloading the workers
+        """
+        return max(0, self.workers + self.queue_size - self.depth)
+
+    async def run(self, func, *args):
+        """
+        Running a single synthesis job in the pool
+        :param func: blocking function to run
+        :return: the function result
+        :raises SpeechQueueFull: when all workers are busy and the queue is full
+        """
+        return await self.submit(func, args)[0]
+
+    def __job(self, func, args: tuple, queued: float):
+        started = time.perf_counter()
+        result = func(*args)
+        finished = time.perf_counter()
+        self.completed += 1
+        self.wait_time += started - queued
+        self.run_time += finished - started
+        logging.info(f"Speech job finished: waited {started - queued:.2f}s, ran {finished - started:.2f}s")
+        return result
+
+    def __done(self, future):
+        self.depth -= 1
+
+    def stats(self):
+        """
+        Queue depth and average job timings for sizing the hosts
+        """
+        return {
+            'workers': self.workers,
+            'depth': self.depth,
+            'completed': self.completed,
+            'avg_wait': self.wait_time / self.completed if self.completed else 0.0,
+            'avg_run': self.run_time / self.completed if self.completed else 0.0,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class OrderedJobs:
+
+    def __init__(self, workers: SpeechWorkers, func, args_list: list):
+        """
+        Jobs of one request in a window of the free queue places, the next jobs are queued as the results
+        are taken, so a long message does not need the whole queue
+        :param workers: speech workers running the jobs
+        :param func: blocking function to run
+        :param args_list: argument tuples, one per job
+        :raises SpeechQueueFull: when the queue is full of the jobs of other requests
+        """
+        self.workers = workers
+        self.func = func
+        self.pending = deque(args_list)
+        self.futures = deque()
+        self.__admit(required=bool(self.pending))
+
+    async def next(self):
+        """
+        Waiting for the result of the next job in order
+        :raises SpeechQueueFull: when none of the jobs is queued and the queue is full of the jobs of other requests
+        """
+        if not self.futures:
+            self.__admit(required=True)
+        result = await self.futures.popleft()
+        # the workers go on with the next jobs while the result is being sent
+        self.__admit()
+        return result
+
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+        self.futures.clear()
+        self.pending.clear()
+
+    def __admit(self, required: bool = False):
+        fit = min(len(self.pending), self.workers.free())
+        if fit == 0:
+            if required:
+                raise SpeechQueueFull(f'{self.workers.depth} speech jobs are already queued')
+            return
+        self.futures.extend(self.workers.submit(self.func, *[self.pending.popleft() for _ in range(fit)]))
+
 
 class Announcer:
 
     def __init__(self, config: dict):
         self.device = torch.device(config['device'])
-        torch.set_num_threads(4)
         self.url_model = {f"models/{config['ru_model_speech']}": 'https://models.silero.ai/models/tts/ru/v3_1_ru.pt',
                           f"models/{config['en_model_speech']}": 'https://models.silero.ai/models/tts/en/v3_en.pt'}
         self.__check_model(f"models/{config['ru_model_speech']}")
         self.__check_model(f"models/{config['en_model_speech']}")
         self._config = config
+        self.models = ModelRegistry(self.device)
+        self.workers = SpeechWorkers(config)
+        self.cache = VoiceCache(config)
+        # language -> (model file, speaker, text preparation for the model)
+        self.routes = {
+            'ru': (f"models/{config['ru_model_speech']}", config['ru_speaker'], self.__translit),
+            'en': (f"models/{config['en_model_speech']}", config['en_speaker'], str),
+        }
+
+    async def warm_up(self):
+        """
+        Loading the speech models and the language profiles before the first request
+        """
+        for local_file, speaker, prepare in self.routes.values():
+            await self.models.get(local_file)
+        await asyncio.to_thread(detect_language, 'warm up')
 
-    async def voicing(self, message: str, chat_id: str):
+    async def voicing(self, message: str):
         """
-        Getting the path to the model-generated file
+        Getting the model-generated voice messages as soon as each of them is ready
         :param message: Message from the model
-        :param chat_id: Telegram chat id
-        :return: the path to the voice message
+        :return: async generator of (cache key, voice) in message order, the voice is a Telegram file id
+                 or an OGG/Opus voice message in memory
+        :raises SpeechQueueFull: when the speech workers are overloaded
         """
-        path_audio = []
-        if detect(message) not in ('ru', 'en'):
+        segments = self.__route(message)
+        if not segments:
             logging.warning('Message language not recognized')
             return
-        chunks = [message[i:i + 900] for i in range(0, len(message), 900)]  # Breaking up the text into chunks
-
-        for n, chunk in enumerate(chunks):
+        async for voice in self.__speak_text(segments):
+            yield voice
 
-            if detect(message) == "ru":
-                path_voice = await self.__speak_text(
-                    message=self.__translit(chunk),
-                    local_file=self.__check_model(f"models/{self._config['ru_model_speech']}"),
-                    speaker=self._config['ru_speaker'],
-                    filename=f'{chat_id}_{n}'
-                )
-
-                path_audio.append(path_voice)
+    def __route(self, message: str):
+        """
+        Splitting the message into runs of paragraphs in one language and chunks for the models
+        :param message: Message from the model
+        :return: list of (language, chunk)
+        """
+        runs = split_languages(message, self.routes)
+        segments = []
+        for language, text in runs:
+            segments.extend((language, chunk) for chunk in split_text(text, 900))
+        return segments
 
-            if detect(message) == "en":
-                path_voice = await self.__speak_text(
-                    message=chunk,
-                    local_file=self.__check_model(f"models/{self._config['en_model_speech']}"),
-                    speaker=self._config['en_speaker'],
-                    filename=f'{chat_id}_{n}'
-                )
-                path_audio.append(path_voice)
+    async def __speak_text(self, segments: list):
+        """
+        Converting text chunks to voices in parallel, reusing the cached ones
+        :param segments: list of (language, chunk) for voicing
+        :return: async generator of (cache key, voice)
+        """
+        jobs = []
+        for language, chunk in segments:
+            local_file, speaker, prepare = self.routes[language]
+            text = prepare(chunk)
+            key = VoiceCache.key(text, language, speaker, self._config['sample_rate'], local_file)
+            jobs.append((key, text, local_file, speaker))
 
-        return path_audio
+        missing = [n for n, job in enumerate(jobs) if job[0] not in self.cache]
+        results = None
+        if missing:
+            models = {}
+            for n in missing:
+                local_file = self.__check_model(jobs[n][2])
+                if local_file not in models:
+                    models[local_file] = await self.models.get(local_file)
+            results = OrderedJobs(self.workers, self.__synthesise, [(models[jobs[n][2]], jobs[n][1], jobs[n][3])
+                                                                    for n in missing])
+            missing = set(missing)
+        try:
+            for n, (key, text, local_file, speaker) in enumerate(jobs):
+                if n in missing:
+                    voice = await results.next()
+                    await self.cache.put(key, voice.getvalue())
+                    yield key, voice
+                    continue
+                cached = await self.cache.get(key)
+                if cached is None:
+                    # evicted after the lookup above
+                    model = await self.models.get(self.__check_model(local_file))
+                    voice = await self.workers.run(self.__synthesise, model, text, speaker)
+                    await self.cache.put(key, voice.getvalue())
+                elif isinstance(cached, bytes):
+                    voice = io.BytesIO(cached)
+                else:
+                    voice = cached
+                yield key, voice
+        finally:
+            if results is not None:
+                results.cancel()
+        logging.info("_Successful text-to-audio verification_")
 
-    async def __speak_text(self, message: str, local_file: str, speaker: str, filename: str):
+    def __synthesise(self, model, message: str, speaker: str):
         """
-        Converting text to a voice
-        :param message: message for voicing
-        :param local_file: path to the file with the model
-        :param speaker: voiceover
-        :param filename: file names to save
-        :return: the path to the voice message
-        """
-        model = torch.package.PackageImporter(local_file).load_pickle('tts_models', 'model')
-        model.to(self.device)
-        audio_paths = await asyncio.to_thread(
-            model.save_wav,
-            text=message,
-            speaker=speaker,
-            sample_rate=self._config["sample_rate"],
-            audio_path=f'voice/{filename}.wav'
-        )
-        logging.info("_Successful text-to-audio verification_")
-        return audio_paths
+        Running the model and encoding the audio without touching the disk
+        """
+        with TTS_INFERENCE.time(speaker=speaker):
+            audio = model.apply_tts(text=message, speaker=speaker, sample_rate=self._config["sample_rate"])
+        voice = io.BytesIO()
+        sf.write(voice, audio.numpy(), self._config["sample_rate"], format='OGG', subtype='OPUS')
+        voice.seek(0)
+        return voice
 
     def __check_model(self, model_speech: str):
         """